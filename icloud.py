@@ -6,25 +6,41 @@ Platform that supports scanning iCloud.
 For more details about this platform, please refer to the documentation at
 https://home-assistant.io/components/icloud/
 """
+import array
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
 import logging
+import json
+import math
+import mmap
+import os
+import threading
 import time as time
 from datetime import datetime, timezone, timedelta
-from pytz import timezone
 import pytz
-from math import floor
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 from pyicloud import PyiCloudService
 from pyicloud.exceptions import PyiCloudFailedLoginException
+from pyicloud.exceptions import PyiCloudAPIResponseError
 
 import re
+import struct
 from homeassistant.const import CONF_USERNAME, CONF_PASSWORD, CONF_NAME
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers.entity import Entity
 from homeassistant.helpers.entity import generate_entity_id
 from homeassistant.components.device_tracker import see
 from homeassistant.helpers.event import track_state_change
 from homeassistant.helpers.event import track_time_change
 from homeassistant.helpers.event import track_point_in_time
+from homeassistant.helpers.event import track_point_in_utc_time
 from homeassistant.helpers.event import track_utc_time_change
 import homeassistant.util.dt as dt_util
 from homeassistant.util.location import distance
@@ -41,6 +57,30 @@ DEFAULT_INTERVAL = 8
 CONF_EVENTS = 'events'
 DEFAULT_EVENTS = False
 
+# minutes the events of the calendar are cached between fetches
+CONF_CALENDAR_REFRESH = 'calendar_refresh'
+DEFAULT_CALENDAR_REFRESH = 15
+
+# meters, or 'accuracy' for the accuracy radius of the previous fix, a
+# device has to move before a new fix is passed on to the device tracker
+CONF_MOVEMENT_THRESHOLD = 'movement_threshold'
+DEFAULT_MOVEMENT_THRESHOLD = None
+THRESHOLD_ACCURACY = 'accuracy'
+
+# minutes after which an unchanged fix is passed on anyway
+CONF_HEARTBEAT = 'heartbeat'
+DEFAULT_HEARTBEAT = 30
+
+# days of events fetched from the calendar
+CALENDAR_WINDOW = 7
+
+# time zones of events kept resolved
+TIMEZONE_CACHE_SIZE = 64
+
+# fields that tell if an event changed
+CALENDAR_FIELDS = ['etag', 'startDate', 'endDate', 'duration', 'title',
+                   'location', 'tz']
+
 # entity attributes
 ATTR_ACCOUNTNAME = 'accountname'
 ATTR_INTERVAL = 'interval'
@@ -56,6 +96,29 @@ ATTR_LOWPOWERMODE = 'low power mode'
 ATTR_BATTERYSTATUS = 'battery status'
 ATTR_LOCATION = 'location'
 ATTR_FRIENDLY_NAME = 'friendly_name'
+ATTR_LOGINS = 'logins'
+ATTR_STARTUPTIME = 'startup time'
+ATTR_RESUMED = 'session resumed'
+ATTR_SEEFORWARDED = 'see forwarded'
+ATTR_NEARESTZONE = 'nearest zone'
+ATTR_ZONEDISTANCE = 'zone distance'
+ATTR_SEESUPPRESSED = 'see suppressed'
+ATTR_CIRCUIT = 'circuit'
+ATTR_SPEED = 'speed'
+ATTR_SNAPSHOTHITS = 'snapshot hits'
+ATTR_SNAPSHOTMISSES = 'snapshot misses'
+ATTR_SNAPSHOTHITRATE = 'snapshot hit rate'
+ATTR_REFINING = 'refining polls'
+ATTR_FAILURES = 'failures in a row'
+ATTR_RETRYAT = 'retry at'
+
+# accountname or devicename of a service call for all accounts or devices,
+# and the event with the results of a service call
+SERVICE_ALL = 'all'
+EVENT_SERVICE_RESULT = 'icloud_service_result'
+
+# state of an account that is still starting
+STATE_LOADING = 'loading'
 
 TYPE_CURRENT = 'currentevent'
 TYPE_NEXT = 'nextevent'
@@ -83,6 +146,216 @@ DEVICESTATUSSET = ['features', 'maxMsgChar', 'darkWake', 'fmlyShare',
                    'wipedTimestamp', 'modelDisplayName', 'locationEnabled',
                    'isMac', 'locFoundEnabled']
 
+# the device status shown for a status code, 'error' for other codes
+DEVICE_STATUSES = {'200': 'online', '201': 'offline', '203': 'pending',
+                   '204': 'unregistered'}
+DEVICE_STATUS_ERROR = 'error'
+
+# columns of the fleet table that holds the hot data of the devices
+FLEET_INTERVAL = 'interval'
+FLEET_LASTPOLL = 'lastpoll'
+FLEET_BATTERY = 'battery'
+FLEET_STATUS = 'status'
+FLEET_DISTANCE = 'distance'
+FLEET_ZONEDISTANCE = 'zonedistance'
+FLEET_FIXZONEDISTANCE = 'fixzonedistance'
+FLEET_HOMEDISTANCE = 'homedistance'
+FLEET_SPEED = 'speed'
+FLEET_SEEFORWARDED = 'seeforwarded'
+FLEET_SEESUPPRESSED = 'seesuppressed'
+FLEET_REFINESTART = 'refinestart'
+FLEET_REFINING = 'refining'
+FLEET_FIX = ['fixlatitude', 'fixlongitude', 'fixaccuracy', 'fixbattery',
+             'fixtime']
+FLEET_COLUMNS = [FLEET_INTERVAL, FLEET_LASTPOLL, FLEET_BATTERY,
+                 FLEET_STATUS, FLEET_DISTANCE, FLEET_ZONEDISTANCE,
+                 FLEET_FIXZONEDISTANCE, FLEET_HOMEDISTANCE, FLEET_SPEED,
+                 FLEET_SEEFORWARDED, FLEET_SEESUPPRESSED, FLEET_REFINESTART,
+                 FLEET_REFINING] + FLEET_FIX
+NAN = float('nan')
+
+# fixes kept per device, and whether they are kept in a file under the
+# session store so they survive a restart
+CONF_HISTORY_SIZE = 'history_size'
+DEFAULT_HISTORY_SIZE = 128
+CONF_HISTORY_STORE = 'history_store'
+DEFAULT_HISTORY_STORE = False
+HISTORY_STORE = 'history'
+HISTORY_MAGIC = b'IFH1'
+HISTORY_HEADER = struct.Struct('<4sIII')
+HISTORY_RECORD = struct.Struct('<ddddd')
+
+# minutes between the polls of a device away from the zones
+CONF_MIN_INTERVAL = 'min_interval'
+DEFAULT_MIN_INTERVAL = 1
+CONF_MAX_INTERVAL = 'max_interval'
+DEFAULT_MAX_INTERVAL = 60
+
+# the newest fixes within the window in minutes, or twice the maximum
+# interval if that is longer, give the speed of a device, below the
+# stationary speed in m/s it stands still, and a moving
+# device is polled again after this fraction of its time to the nearest zone
+SPEED_FIXES = 5
+SPEED_WINDOW = 15
+STATIONARY_SPEED = 0.5
+ETA_FRACTION = 0.5
+
+# meters of accuracy a fix needs before it goes to the device tracker
+# without refinement
+MIN_HORIZONTAL_ACCURACY = 100
+
+# fields of the device status, and of its location, kept by a fleet refresh:
+# the fields read by a poll, or all of them for the discovery of the devices
+PROFILE_LOCATION = 'location'
+PROFILE_FULL = 'full'
+FIELD_PROFILES = {
+    PROFILE_LOCATION: (['id', 'name', 'deviceStatus', 'lowPowerMode',
+                        'batteryStatus', 'batteryLevel', 'location'],
+                       ['latitude', 'longitude', 'horizontalAccuracy',
+                        'timeStamp', 'locationFinished', 'isOld',
+                        'isInaccurate']),
+    PROFILE_FULL: (DEVICESTATUSSET, None)
+}
+
+# seconds the snapshot of a device may be reused by a scheduled poll, a
+# manual update or a single device refresh; the services refresh
+FLEET_MAX_AGE = 15
+
+# threads running the calls to iCloud and the seconds a single call may take
+ENGINE_WORKERS = 8
+REQUEST_TIMEOUT = 30
+
+# calls per second to iCloud and their bursts, of all accounts and of one
+# account
+RATE_GLOBAL = 5
+BURST_GLOBAL = 20
+RATE_ACCOUNT = 0.5
+BURST_ACCOUNT = 5
+
+# priorities of the calls to iCloud, lowest first
+PRIORITY_USER = 0
+PRIORITY_NEAR = 1
+PRIORITY_BACKGROUND = 2
+
+# km to the edge of the nearest zone within which a device polls with
+# priority
+NEAR_ZONE_DISTANCE = 10
+
+# seconds an account throttled by iCloud is paused, doubled on every
+# throttling error up to the maximum
+THROTTLE_BACKOFF = 30
+THROTTLE_MAX_BACKOFF = 900
+THROTTLE_ERROR_CODES = [429, 503]
+THROTTLE_ERROR_REASONS = ['Too Many Requests', 'Service Unavailable']
+
+# seconds a call of the services waits for a paused account or for its
+# turn in the rate limiter; the other calls of a paused account fail at
+# once and wait for their turn as long as it takes
+LIMITER_TIMEOUT = 10
+
+# failures in a row after which the calls of an account are paused, and
+# the seconds of the first pause, doubled on every failure up to the maximum
+BREAKER_THRESHOLD = 3
+BREAKER_BACKOFF = 60
+BREAKER_MAX_BACKOFF = 3600
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+# seconds between the polls of different accounts
+SCHEDULER_SPREAD = 2
+
+# degrees of the cells of the zone index and the rings of cells searched
+# around a device before all zones are compared
+PROXIMITY_CELL = 0.5
+PROXIMITY_RINGS = 3
+
+# directory under the config dir where the sessions of the accounts are kept
+SESSION_STORE = '.icloud'
+
+# milliseconds bounds of the latency histograms of the calls to iCloud and
+# the minutes covered by the rolling counts
+STATS_BUCKETS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+STATS_WINDOW = 60
+
+# operations counted per account
+STATS_LOGIN = 'login'
+STATS_FLEET = 'fleet'
+STATS_CALENDAR = 'calendar'
+STATS_SOUND = 'sound'
+STATS_WRITE = 'state write'
+
+AUTH_ERROR_CODES = [401, 421, 450]
+AUTH_ERROR_REASONS = ['Unauthorized', 'Missing X-APPLE-WEBAUTH-TOKEN cookie',
+                      'Invalid global session']
+
+
+def devicename_from(name):
+    """ Returns the devicename used for the entity ids of a device. """
+    return re.sub(r"(\s|\W|')", '', name).lower()
+
+
+def device_status(content, profile=PROFILE_FULL):
+    """ Returns the fields of a profile of the content of an AppleDevice. """
+    fields, locationfields = FIELD_PROFILES[profile]
+    status = {field: content.get(field) for field in fields}
+    location = status.get('location')
+    if location and locationfields is not None:
+        status['location'] = {field: location.get(field)
+                              for field in locationfields}
+    return status
+
+
+@functools.lru_cache(maxsize=TIMEZONE_CACHE_SIZE)
+def get_timezone(name):
+    """ Returns the time zone of an event, UTC if it has none """
+    if name is None:
+        return pytz.utc
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        _LOGGER.warning("Unknown time zone %s, using UTC", name)
+        return pytz.utc
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Returns the great circle distance between two points in meters """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    hav = (math.sin((lat2 - lat1) / 2) ** 2 +
+           math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371008.8 * math.asin(min(1, math.sqrt(hav)))
+
+
+def event_timestamp(date, tz):
+    """ Returns the epoch seconds of the startDate or endDate of an event """
+    return tz.localize(datetime(date[1], date[2], date[3], date[4],
+                                date[5])).timestamp()
+
+
+def is_auth_error(error):
+    """ Returns True if the error means the session has to log in again.
+
+    Other errors, like an error page pyicloud can't parse, are not fixed
+    by a login and go to the circuit breaker of the account.
+    """
+    return (getattr(error, 'code', None) in AUTH_ERROR_CODES or
+            getattr(error, 'reason', None) in AUTH_ERROR_REASONS)
+
+
+def is_throttle_error(error):
+    """ Returns True if iCloud asks to slow down. """
+    return (getattr(error, 'code', None) in THROTTLE_ERROR_CODES or
+            getattr(error, 'reason', None) in THROTTLE_ERROR_REASONS)
+
+
+def service_targets(value):
+    """ Returns the names a service call is for, None for all of them. """
+    if value is None or value == SERVICE_ALL:
+        return None
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
 
 def setup(hass, config):
     """ Set up the iCloud Scanner. """
@@ -90,6 +363,10 @@ def setup(hass, config):
     if config.get(DOMAIN) is None:
         return False
 
+    SCHEDULER.start(hass)
+    PROXIMITY.start(hass)
+
+    accounts = {}
     for account, account_config in config[DOMAIN].items():
 
         if not isinstance(account_config, dict):
@@ -104,6 +381,10 @@ def setup(hass, config):
             _LOGGER.error("Missing password for account %s", account)
             continue
         
+        accounts[account] = account_config
+
+    def setup_account(account, account_config):
+        """ Adds an account and starts it in the background """
         # Get the username and password from the configuration
         username = account_config.get(CONF_USERNAME)
         password = account_config.get(CONF_PASSWORD)
@@ -115,22 +396,43 @@ def setup(hass, config):
                 ignored_devices.append(each_dev)
         
         getevents = account_config.get(CONF_EVENTS, DEFAULT_EVENTS)
+        calendarrefresh = account_config.get(CONF_CALENDAR_REFRESH,
+                                             DEFAULT_CALENDAR_REFRESH)
+        movementthreshold = account_config.get(CONF_MOVEMENT_THRESHOLD,
+                                               DEFAULT_MOVEMENT_THRESHOLD)
+        if (movementthreshold is not None and
+                movementthreshold != THRESHOLD_ACCURACY):
+            movementthreshold = float(movementthreshold)
+        heartbeat = account_config.get(CONF_HEARTBEAT, DEFAULT_HEARTBEAT)
+        historysize = int(account_config.get(CONF_HISTORY_SIZE,
+                                             DEFAULT_HISTORY_SIZE))
+        historystore = account_config.get(CONF_HISTORY_STORE,
+                                          DEFAULT_HISTORY_STORE)
+        mininterval = account_config.get(CONF_MIN_INTERVAL,
+                                         DEFAULT_MIN_INTERVAL)
+        maxinterval = account_config.get(CONF_MAX_INTERVAL,
+                                         DEFAULT_MAX_INTERVAL)
         
         icloudaccount = Icloud(hass, username, password, account,
-                               ignored_devices, getevents)
+                               ignored_devices, getevents, calendarrefresh,
+                               movementthreshold, heartbeat, historysize,
+                               historystore, mininterval, maxinterval)
         icloudaccount.update_ha_state()
-        ICLOUDTRACKERS[account] = icloudaccount
-        if ICLOUDTRACKERS[account].api is not None:
-            for device in ICLOUDTRACKERS[account].devices:
-                iclouddevice = ICLOUDTRACKERS[account].devices[device]
-                devicename = iclouddevice.devicename.lower()
-                track_state_change(hass,
-                                   'device_tracker.' + devicename,
-                                   iclouddevice.devicechanged)
                                    
         if 'manual_update' in account_config:
             def update_now(now):
-                ICLOUDTRACKERS[account].update_icloud(see)
+                """ Updates all devices of the account """
+                try:
+                    icloudaccount.update_icloud(see, max_age=FLEET_MAX_AGE)
+                except ICallRefusedError as error:
+                    _LOGGER.debug("Skipped the manual update of iCloud "
+                                  "account %s: %s", account, error)
+                except asyncio.TimeoutError:
+                    _LOGGER.warning("iCloud didn't answer in time for the "
+                                    "manual update of account %s", account)
+                except Exception as error:
+                    _LOGGER.error("Error updating iCloud account %s: %s",
+                                  account, error)
             
             manual_update = account_config.get('manual_update')
             for each_time in manual_update:
@@ -139,40 +441,118 @@ def setup(hass, config):
                                   hour=each_time.hour,
                                   minute=each_time.minute,
                                   second=each_time.second)
+        ICLOUDTRACKERS[account] = icloudaccount
+
+        # Log in, discover the devices and load the calendar in the
+        # background, the account shows loading until then
+        def started(future):
+            """ Logs an account that failed to start """
+            if future.exception() is not None:
+                _LOGGER.error("Error setting up iCloud account %s: %s",
+                              account, future.exception())
+
+        ENGINE.submit(icloudaccount.async_start()).add_done_callback(started)
+
+    for account, account_config in accounts.items():
+        setup_account(account, account_config)
         
     if not ICLOUDTRACKERS:
         _LOGGER.error("No ICLOUDTRACKERS added")
         return False
         
     randomseconds = random.randint(10, 59)
-        
+
+    def run_service(service, call, action):
+        """ Runs a service for one, a list or all accounts side by side.
+
+        The action gets the account and the devicename of the call and
+        returns the error of every device or None. The results of all
+        accounts and devices and the seconds they took are fired as an
+        icloud_service_result event.
+        """
+        start = time.time()
+        accountnames = call.data.get(ATTR_ACCOUNTNAME)
+        if accountnames is None:
+            _LOGGER.error("No accountname given for service %s", service)
+            return
+        accountnames = service_targets(accountnames)
+        if accountnames is None:
+            accountnames = list(ICLOUDTRACKERS)
+        devicename = call.data.get(ATTR_DEVICENAME)
+
+        async def timed(account):
+            """ Runs the action for an account and times it """
+            began = time.time()
+            devices = await action(account, devicename)
+            return devices, time.time() - began
+
+        results = {}
+        known = []
+        for accountname in accountnames:
+            if accountname in ICLOUDTRACKERS:
+                known.append(accountname)
+            else:
+                _LOGGER.error("accountname %s unknown", accountname)
+                results[accountname] = {'error': 'unknown account'}
+        outcomes = ENGINE.run_all([timed(ICLOUDTRACKERS[accountname])
+                                   for accountname in known])
+        failed = len(results)
+        for accountname, outcome in zip(known, outcomes):
+            if isinstance(outcome, Exception):
+                failed += 1
+                results[accountname] = {'error': str(outcome)}
+                continue
+            devices, seconds = outcome
+            failed += sum(error is not None for error in devices.values())
+            results[accountname] = {
+                'seconds': round(seconds, 3),
+                'devices': {name: error or 'ok'
+                            for name, error in devices.items()}}
+        seconds = round(time.time() - start, 3)
+        hass.bus.fire(EVENT_SERVICE_RESULT, {'service': service,
+                                             'seconds': seconds,
+                                             'results': results})
+        _LOGGER.info("iCloud service %s for %s account(s) took %s seconds, "
+                     "%s failed", service, len(accountnames), seconds, failed)
+
     def lost_iphone(call):
-        """ Calls the lost iphone function if the device is found """
-        accountname = call.data.get('accountname')
-        devicename = call.data.get('devicename')
-        if accountname in ICLOUDTRACKERS:
-            ICLOUDTRACKERS[accountname].lost_iphone(devicename)
+        """ Plays a sound on the devices of one, a list or all accounts """
+        run_service('lost_iphone', call,
+                    lambda account, devicename:
+                    account.async_lost_iphone(devicename))
 
     hass.services.register(DOMAIN, 'lost_iphone',
                            lost_iphone)
                            
     def update_icloud(call):
-        """ Calls the update function of an icloud account """
-        accountname = call.data.get('accountname')
-        devicename = call.data.get('devicename')
-        if accountname in ICLOUDTRACKERS:
-            ICLOUDTRACKERS[accountname].update_icloud(see, devicename)
+        """ Updates the devices of one, a list or all accounts """
+        run_service('update_icloud', call,
+                    lambda account, devicename:
+                    account.async_update_icloud(see, devicename,
+                                                PRIORITY_USER))
     hass.services.register(DOMAIN,
                            'update_icloud', update_icloud)
             
     def keep_alive(now):
         """ Keeps the api logged in of all account """
-        for accountname in ICLOUDTRACKERS:
-            try:
-                ICLOUDTRACKERS[accountname].keep_alive()
-            except ValueError:
-                _LOGGER.info("something went wrong for this account, " +
-                             "retrying in a minute")
+        accountnames = list(ICLOUDTRACKERS)
+        clock = TickClock()
+        results = ENGINE.run_all(
+            [ICLOUDTRACKERS[accountname].async_keep_alive(clock)
+             for accountname in accountnames])
+        for accountname, result in zip(accountnames, results):
+            if isinstance(result, ICallRefusedError):
+                _LOGGER.debug("Skipped iCloud account %s: %s", accountname,
+                              result)
+            elif isinstance(result, ValueError):
+                _LOGGER.info("something went wrong for account %s, "
+                             "retrying in a minute", accountname)
+            elif isinstance(result, asyncio.TimeoutError):
+                _LOGGER.warning("iCloud didn't answer in time for account "
+                                "%s, retrying in a minute", accountname)
+            elif isinstance(result, Exception):
+                _LOGGER.error("Error updating iCloud account %s: %s",
+                              accountname, result)
             
     track_utc_time_change(
         hass, keep_alive,
@@ -180,36 +560,1082 @@ def setup(hass, config):
     )
     
     def setinterval(call):
-        """ Calls the update function of an icloud account """
-        accountname = call.data.get('accountname')
-        interval = call.data.get('interval')
-        if accountname in ICLOUDTRACKERS:
-            ICLOUDTRACKERS[accountname].setinterval(interval)
+        """ Sets the interval of the devices of one, a list or all accounts
+        and updates them """
+        interval = call.data.get(ATTR_INTERVAL)
+
+        async def update(account, devicename):
+            """ Sets the intervals and updates the devices of an account """
+            account.setinterval(interval, devicename, update=False)
+            return await account.async_update_icloud(see, devicename,
+                                                     PRIORITY_USER)
+
+        run_service('setinterval', call, update)
 
     hass.services.register(DOMAIN,
                            'setinterval', setinterval)
 
+    def stop_engine(event):
+        """ Stops the engine running the calls to iCloud and closes the
+        fix histories """
+        ENGINE.stop()
+        for account in list(ICLOUDTRACKERS.values()):
+            for idevice in account.devices.values():
+                idevice.history.close()
+
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, stop_engine)
+
     # Tells the bootstrapper that the component was successfully initialized
     return True
 
-class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
+class IcloudEngine(object):
+    """ Runs the blocking pyicloud calls off a private asyncio loop.
+
+    Calls to iCloud run in a thread pool with a deadline each, so calls for
+    different accounts and devices overlap and a tick takes as long as its
+    slowest call. The sync methods of Icloud and IDevice wrap coroutines
+    that are run on this loop.
+    """
+    def __init__(self, workers=ENGINE_WORKERS, timeout=REQUEST_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._loop = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """ Starts the loop thread the first time it is needed """
+        with self._lock:
+            if self._loop is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run, args=(self._loop,),
+                                 name='icloud', daemon=True).start()
+        return self._loop
+
+    @staticmethod
+    def _run(loop):
+        """ Runs the loop until it is stopped, then closes it """
+        loop.run_forever()
+        loop.close()
+
+    async def call(self, func, *args, timeout=None):
+        """ Runs a blocking call in the pool and waits for its deadline """
+        return await asyncio.wait_for(
+            self._loop.run_in_executor(self._executor,
+                                       functools.partial(func, *args)),
+            timeout or self.timeout)
+
+    def submit(self, coro):
+        """ Starts a coroutine on the loop and returns its future """
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def run(self, coro):
+        """ Runs a coroutine on the loop and returns its result """
+        return self.submit(coro).result()
+
+    def run_all(self, coros):
+        """ Runs coroutines side by side, returns results or exceptions """
+        async def gather():
+            """ Waits for all coroutines """
+            return await asyncio.gather(*coros, return_exceptions=True)
+        return self.run(gather())
+
+    def stop(self):
+        """ Stops the loop, which its thread then closes, and the thread
+        pool """
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._executor.shutdown(wait=False)
+                self._loop = None
+                self._executor = None
+
+ENGINE = IcloudEngine()
+
+
+class ITokenBucket(object):
+    """ Tokens refilled at a steady rate up to a burst. """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused = 0
+
+    def wait(self, now):
+        """ Returns the seconds until a token is available """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused:
+            return self.paused - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Takes a token """
+        self.tokens -= 1
+
+
+class IcloudRateLimiter(object):
+    """ Paces the calls to iCloud with token buckets.
+
+    Every call takes a token of its account and one of the global bucket.
+    Waiting calls are let through by priority: calls of the services first,
+    then polls of devices near a zone, then the background. An account that
+    is throttled by iCloud is paused with a backoff that doubles until a
+    call succeeds again; meanwhile its calls fail at once with
+    IThrottledError, but those of the services, which wait if the pause
+    ends within LIMITER_TIMEOUT. The services don't wait longer than that
+    for their turn either, the other calls do. Runs on the loop of the
+    engine.
+    """
+    def __init__(self, rate=RATE_GLOBAL, burst=BURST_GLOBAL,
+                 account_rate=RATE_ACCOUNT, account_burst=BURST_ACCOUNT):
+        self._global = ITokenBucket(rate, burst)
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self._accounts = {}
+        self._backoff = {}
+        self._waiting = []
+        self._order = itertools.count()
+        self._timer = None
+
+    def _bucket(self, accountname):
+        """ Returns the token bucket of an account """
+        bucket = self._accounts.get(accountname)
+        if bucket is None:
+            bucket = self._accounts[accountname] = ITokenBucket(
+                self.account_rate, self.account_burst)
+        return bucket
+
+    def _refuses(self, accountname, priority, now):
+        """ Returns True if the pause of an account refuses a call """
+        paused = self._bucket(accountname).paused
+        return now < paused and (priority != PRIORITY_USER or
+                                 paused - now > LIMITER_TIMEOUT)
+
+    async def acquire(self, accountname, priority=PRIORITY_BACKGROUND):
+        """ Waits until the account may make a call to iCloud.
+
+        Raises IThrottledError if the account is paused and
+        IQueueTimeoutError if a call of the services didn't get its turn
+        within LIMITER_TIMEOUT.
+        """
+        bucket = self._bucket(accountname)
+        if self._refuses(accountname, priority, time.time()):
+            raise IThrottledError(accountname, bucket.paused)
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting,
+                       (priority, next(self._order), accountname, future))
+        self._dispatch()
+        if priority != PRIORITY_USER:
+            await future
+            return
+        try:
+            await asyncio.wait_for(future, LIMITER_TIMEOUT)
+        except asyncio.TimeoutError:
+            now = time.time()
+            raise IQueueTimeoutError(accountname, now + max(
+                bucket.wait(now), self._global.wait(now)))
+
+    def _dispatch(self):
+        """ Lets the waiting calls through that have tokens """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.time()
+        waiting = []
+        waits = []
+        for entry in sorted(self._waiting):
+            future = entry[3]
+            if future.done():
+                # the call timed out or was cancelled while waiting
+                continue
+            bucket = self._bucket(entry[2])
+            if self._refuses(entry[2], entry[0], now):
+                # the account was throttled while the call waited
+                future.set_exception(IThrottledError(entry[2],
+                                                     bucket.paused))
+                continue
+            wait = max(bucket.wait(now), self._global.wait(now))
+            if wait:
+                waiting.append(entry)
+                waits.append(wait)
+            else:
+                bucket.take()
+                self._global.take()
+                future.set_result(None)
+        # a sorted list is a heap
+        self._waiting = waiting
+        if waiting:
+            self._timer = asyncio.get_event_loop().call_later(
+                min(waits), self._dispatch)
+
+    def throttled(self, accountname):
+        """ Pauses the calls of an account throttled by iCloud """
+        backoff = min(THROTTLE_MAX_BACKOFF,
+                      self._backoff.get(accountname, THROTTLE_BACKOFF / 2) * 2)
+        self._backoff[accountname] = backoff
+        bucket = self._bucket(accountname)
+        bucket.paused = time.time() + backoff
+        bucket.tokens = 0
+        _LOGGER.warning("iCloud is throttling account %s, pausing its calls "
+                        "for %s seconds", accountname, backoff)
+
+    def recovered(self, accountname):
+        """ Resets the backoff of an account after a successful call """
+        self._backoff.pop(accountname, None)
+
+LIMITER = IcloudRateLimiter()
+
+
+class IcloudScheduler(object):
+    """ Polls every device when it is due.
+
+    A heap holds the next due time of every device and the scheduler only
+    wakes up when the first one is due. Devices of the same account that
+    are nearly due are polled along, they share the fleet refresh. Polls of
+    different accounts are kept SCHEDULER_SPREAD seconds apart.
+    """
+    def __init__(self, spread=SCHEDULER_SPREAD):
+        self.hass = None
+        self.spread = spread
+        self._queue = []
+        self._due = {}
+        self._devices = {}
+        self._slots = {}
+        self._wakeup = None
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self, hass):
+        """ Starts waking up for the devices that are due """
+        with self._lock:
+            self.hass = hass
+            self._wakeup = None
+            self._arm()
+
+    def schedule(self, idevice, due=None):
+        """ Schedules the next poll of a device, replacing the previous """
+        key = (idevice.icloudobject.accountname, idevice.devicename)
+        if due is None:
+            due = idevice.next_poll()
+        with self._lock:
+            due = self._spread(key[0], max(due, time.time()))
+            self._due[key] = due
+            self._devices[key] = idevice
+            slot = self._slots.setdefault(int(due), {})
+            slot[key[0]] = slot.get(key[0], 0) + 1
+            heapq.heappush(self._queue, (due, next(self._counter), key))
+            self._arm()
+
+    def _spread(self, accountname, due):
+        """ Moves the due time away from the polls of other accounts """
+        for _ in range(30):
+            for second in range(int(due) - self.spread + 1,
+                                int(due) + self.spread):
+                if any(account != accountname
+                       for account in self._slots.get(second, {})):
+                    break
+            else:
+                return due
+            due += self.spread
+        return due
+
+    def _release(self, accountname, due):
+        """ Frees the slot of a poll that left the heap """
+        slot = self._slots.get(int(due))
+        if slot is not None and accountname in slot:
+            slot[accountname] -= 1
+            if slot[accountname] <= 0:
+                del slot[accountname]
+            if not slot:
+                del self._slots[int(due)]
+
+    def _arm(self):
+        """ Wakes up when the first device is due """
+        if not self._queue or self.hass is None:
+            return
+        due = self._queue[0][0]
+        if self._wakeup is not None and self._wakeup <= due:
+            return
+        self._wakeup = due
+        track_point_in_utc_time(self.hass, self._wake,
+                                dt_util.utc_from_timestamp(due))
+
+    def _wake(self, now):
+        """ Polls the devices that are due, one fleet refresh per account """
+        polls = {}
+        with self._lock:
+            self._wakeup = None
+            current = time.time()
+            # the timer fires on whole seconds
+            while self._queue and self._queue[0][0] <= current + 1:
+                due, _, key = heapq.heappop(self._queue)
+                self._release(key[0], due)
+                if self._due.get(key) != due:
+                    continue
+                del self._due[key]
+                polls.setdefault(key[0], []).append(self._devices[key])
+            for key in list(self._due):
+                idevice = self._devices[key]
+                if (key[0] in polls and
+                        self._due[key] - current <= idevice.poll_tolerance()):
+                    del self._due[key]
+                    polls[key[0]].append(idevice)
+            self._arm()
+        if not polls:
+            return
+        accountnames = list(polls)
+        results = ENGINE.run_all(
+            [polls[accountname][0].icloudobject.async_poll_devices(
+                [idevice.devicename for idevice in polls[accountname]])
+             for accountname in accountnames])
+        for accountname, result in zip(accountnames, results):
+            if isinstance(result, ICallRefusedError):
+                _LOGGER.debug("Skipped polling iCloud account %s: %s",
+                              accountname, result)
+            elif isinstance(result, Exception):
+                _LOGGER.error("Error polling iCloud account %s: %s",
+                              accountname, result)
+            # a failed poll is tried again after the interval of the device
+            for idevice in polls[accountname]:
+                if (accountname, idevice.devicename) not in self._due:
+                    self.schedule(idevice, time.time() +
+                                  idevice.interval_seconds())
+
+SCHEDULER = IcloudScheduler()
+
+
+class IcloudProximity(object):
+    """ Finds the nearest zone of the devices.
+
+    The zones are indexed in a grid of PROXIMITY_CELL degrees, which is
+    rebuilt only after a zone changed. A device is compared with the zones
+    in the rings of cells around it; all zones are compared only if none of
+    them is close enough.
+    """
+    def __init__(self, cell=PROXIMITY_CELL, rings=PROXIMITY_RINGS):
+        self.hass = None
+        self.cell = cell
+        self.rings = rings
+        self._zones = []
+        self._grid = {}
+        self._home = None
+        self._maxradius = 0
+        self._dirty = True
+        self._lock = threading.Lock()
+
+    def start(self, hass):
+        """ Starts following the zones known at the start """
+        self.hass = hass
+        self._dirty = True
+        zones = hass.states.entity_ids('zone')
+        if zones:
+            track_state_change(hass, zones, self._zone_changed)
+
+    def _zone_changed(self, entity, old_state, new_state):
+        """ Rebuilds the index after a zone changed """
+        self._dirty = True
+
+    def _cellof(self, latitude, longitude):
+        """ Returns the cell of the grid a point lies in """
+        return (int(math.floor(latitude / self.cell)),
+                int(math.floor(longitude / self.cell)))
+
+    def _refresh(self):
+        """ Indexes the zones """
+        zones = []
+        for entity_id in self.hass.states.entity_ids('zone'):
+            state = self.hass.states.get(entity_id)
+            if state is None or 'latitude' not in state.attributes:
+                continue
+            zones.append((entity_id, state.attributes['latitude'],
+                          state.attributes['longitude'],
+                          state.attributes.get('radius', 0) or 0))
+        grid = {}
+        for zone in zones:
+            grid.setdefault(self._cellof(zone[1], zone[2]), []).append(zone)
+        self._zones = zones
+        self._grid = grid
+        self._home = next((zone for zone in zones if zone[0] == 'zone.home'),
+                          None)
+        self._maxradius = max([zone[3] for zone in zones] or [0])
+        self._dirty = False
+
+    def nearest(self, fixes):
+        """ Returns the nearest zone, the distance to its edge and the
+        distance to home in km for each (latitude, longitude) fix """
+        with self._lock:
+            if self._dirty and self.hass is not None:
+                self._refresh()
+            return [self._nearest(latitude, longitude)
+                    for latitude, longitude in fixes]
+
+    def _nearest(self, latitude, longitude):
+        """ Returns the proximity of one fix """
+        home = None
+        if self._home is not None:
+            home = round(haversine(latitude, longitude, self._home[1],
+                                   self._home[2]) / 1000, 1)
+        row, col = self._cellof(latitude, longitude)
+        best = None
+        bestdistance = None
+        for ring in range(self.rings + 1):
+            for cellrow in range(row - ring, row + ring + 1):
+                for cellcol in range(col - ring, col + ring + 1):
+                    if max(abs(cellrow - row), abs(cellcol - col)) != ring:
+                        continue
+                    for zone in self._grid.get((cellrow, cellcol), ()):
+                        zonedistance = max(0, haversine(
+                            latitude, longitude, zone[1], zone[2]) - zone[3])
+                        if best is None or zonedistance < bestdistance:
+                            best = zone
+                            bestdistance = zonedistance
+            # zones beyond this ring are at least this far away
+            reach = ring * self.cell * 111195 * math.cos(math.radians(
+                min(89, abs(latitude) + (ring + 1) * self.cell)))
+            if best is not None and bestdistance <= reach - self._maxradius:
+                break
+        else:
+            for zone in self._zones:
+                zonedistance = max(0, haversine(
+                    latitude, longitude, zone[1], zone[2]) - zone[3])
+                if best is None or zonedistance < bestdistance:
+                    best = zone
+                    bestdistance = zonedistance
+        if best is None:
+            return None, None, home
+        return best[0], round(bestdistance / 1000, 1), home
+
+PROXIMITY = IcloudProximity()
+
+
+class ISessionStore(object):
+    """ Keeps the login data of an account on disk between restarts. """
+    def __init__(self, directory, username):
+        self.directory = directory
+        self.path = os.path.join(
+            directory, re.sub(r"\W", '', username) + '.json')
+
+    def load(self):
+        """ Returns the stored login data or None """
+        try:
+            with open(self.path) as storefile:
+                data = json.load(storefile)
+            return data if 'webservices' in data else None
+        except (IOError, ValueError):
+            return None
+
+    def save(self, data):
+        """ Stores the login data, readable for the owner only """
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory, 0o700)
+            storefile = os.open(self.path,
+                                os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(storefile, 'w') as storefile:
+                json.dump(data, storefile)
+        except (IOError, OSError, TypeError) as error:
+            _LOGGER.warning("Unable to store the iCloud session in %s: %s",
+                            self.path, error)
+
+
+class StoredPyiCloudService(PyiCloudService):
+    """ PyiCloudService that resumes a stored session instead of logging in.
+
+    The cookies are kept by pyicloud in the store directory, the login data
+    by the ISessionStore. If iCloud rejects the resumed session the first
+    call fails with an auth error and ISession logs in for real.
+    """
+    def __init__(self, username, password, store, verify=True):
+        self.store = store
+        self.logins = 0
+        self.resumed = False
+        self._resume = True
+        super(StoredPyiCloudService, self).__init__(
+            username, password, cookie_directory=store.directory,
+            verify=verify)
+
+    def authenticate(self):
+        """ Resumes the stored session once, logs in after that """
+        if self._resume:
+            self._resume = False
+            data = self.store.load()
+            if data is not None:
+                self.params.update({'dsid': data['dsInfo']['dsid']})
+                self.data = data
+                self.webservices = data['webservices']
+                self.resumed = True
+                return
+        self.resumed = False
+        if not os.path.exists(self.store.directory):
+            os.makedirs(self.store.directory, 0o700)
+        super(StoredPyiCloudService, self).authenticate()
+        self.logins += 1
+        self.store.save(self.data)
+
+
+class ICallRefusedError(Exception):
+    """ Raised for a call of an account that isn't made now. """
+    message = "calls of account %s are refused for %s seconds"
+
+    def __init__(self, accountname, retry_at):
+        super(ICallRefusedError, self).__init__(
+            self.message %
+            (accountname, max(0, round(retry_at - time.time()))))
+        self.accountname = accountname
+        self.retry_at = retry_at
+
+
+class ICircuitOpenError(ICallRefusedError):
+    """ Raised for a call of an account whose circuit is open. """
+    message = "calls of account %s are paused for %s seconds"
+
+
+class IThrottledError(ICallRefusedError):
+    """ Raised for a call of an account paused after iCloud throttled
+    it. """
+    message = "calls of account %s are throttled for %s seconds"
+
+
+class IQueueTimeoutError(ICallRefusedError):
+    """ Raised for a call of the services that didn't get its turn in the
+    rate limiter in time. """
+    message = ("calls of account %s are queued in the rate limiter, a "
+               "token is due in %s seconds")
+
+
+class ICircuitBreaker(object):
+    """ Stops calling iCloud for an account that keeps failing.
+
+    After BREAKER_THRESHOLD failures in a row, or one failed login, the
+    circuit opens and calls are refused for a backoff that doubles with
+    every failure, with jitter so accounts don't retry in step. When the
+    backoff has passed one probe call is let through (half-open): if it
+    succeeds the circuit closes, if it fails it opens again.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF,
+                 max_backoff=BREAKER_MAX_BACKOFF):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.retry_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Returns True if a call may be made now """
+        with self._lock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self._probing or time.time() < self.retry_at:
+                return False
+            self.state = BREAKER_HALF_OPEN
+            self._probing = True
+            return True
+
+    def cancel(self):
+        """ Gives back a call that was allowed but not made """
+        with self._lock:
+            if self._probing:
+                # the next call probes again
+                self.state = BREAKER_OPEN
+                self._probing = False
+
+    def success(self):
+        """ Closes the circuit after a successful call """
+        with self._lock:
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.retry_at = None
+            self._probing = False
+
+    def failure(self, trip=False):
+        """ Counts a failed call, opening the circuit if needed """
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if (trip or self.state == BREAKER_HALF_OPEN or
+                    self.failures >= self.threshold):
+                backoff = min(self.max_backoff, self.backoff * 2 ** max(
+                    0, self.failures - self.threshold))
+                self.state = BREAKER_OPEN
+                self.retry_at = time.time() + random.uniform(backoff / 2,
+                                                             backoff)
+
+
+class ISession(object):
+    """ Tracks the validity of the pyicloud session of an account.
+
+    The session is only logged in again when iCloud rejects it, never on
+    a timer: every login may send an email to the owner of the account.
+    """
+    def __init__(self, api, stats=None):
+        self.api = api
+        self.stats = stats
+        # PyiCloudService logs in when it is created
+        self._validated = time.time()
+        self._lock = threading.Lock()
+
+    def authenticate(self):
+        """ Logs in to iCloud again """
+        self._validated = None
+        if self.stats is not None:
+            with self.stats.timed(STATS_LOGIN):
+                self.api.authenticate()
+        else:
+            self.api.authenticate()
+        self._validated = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """ Calls iCloud, logging in again on an auth error """
+        with self._lock:
+            if self._validated is None:
+                # the last login failed
+                self.authenticate()
+        called = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except PyiCloudAPIResponseError as error:
+            if not is_auth_error(error):
+                raise
+            with self._lock:
+                # calls running at the same time only log in once
+                if self._validated is None or self._validated < called:
+                    _LOGGER.info("iCloud session expired, logging in "
+                                 "again: %s", error)
+                    self.authenticate()
+            result = func(*args, **kwargs)
+        self._validated = time.time()
+        return result
+
+class IcloudStats(object):
+    """ Counts the calls of an account to iCloud and how long they take.
+
+    Per operation a total and error count, a latency histogram and counts
+    per minute over the last STATS_WINDOW minutes are kept. Recording a
+    call is a few additions under a lock, cheap enough to leave on.
+    """
+    def __init__(self, buckets=STATS_BUCKETS, window=STATS_WINDOW):
+        self.buckets = buckets
+        self.window = window
+        self._operations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, error=False):
+        """ Records one call of an operation """
+        milliseconds = seconds * 1000
+        minute = int(time.time() // 60)
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = {
+                    'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                    'minutes': collections.deque()}
+            stats['count'] += 1
+            stats['errors'] += bool(error)
+            stats['total'] += milliseconds
+            stats['max'] = max(stats['max'], milliseconds)
+            stats['histogram'][bisect.bisect_right(self.buckets,
+                                                   milliseconds)] += 1
+            minutes = stats['minutes']
+            if not minutes or minutes[-1][0] != minute:
+                minutes.append([minute, 0, 0])
+                while minutes[0][0] <= minute - self.window:
+                    minutes.popleft()
+            minutes[-1][1] += 1
+            minutes[-1][2] += bool(error)
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        """ Records the call made inside the block, failed if it raises """
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.record(operation, time.time() - start, True)
+            raise
+        self.record(operation, time.time() - start)
+
+    def attributes(self):
+        """ Returns the statistics as entity attributes """
+        since = int(time.time() // 60) - self.window
+        labels = ['<%s ms' % bucket for bucket in self.buckets]
+        labels.append('>%s ms' % self.buckets[-1])
+        attributes = {}
+        with self._lock:
+            for operation, stats in self._operations.items():
+                recent = [counts for counts in stats['minutes']
+                          if counts[0] > since]
+                attributes[operation + ' calls'] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'last hour': sum(counts[1] for counts in recent),
+                    'errors last hour': sum(counts[2] for counts in recent),
+                    'mean ms': round(stats['total'] / stats['count'], 1),
+                    'max ms': round(stats['max'], 1),
+                    'histogram': dict(zip(labels, stats['histogram']))}
+        return attributes
+
+
+class IcloudStateWriter(object):
+    """ Writes the states of the iCloud entities.
+
+    A write is skipped when state and attributes equal the last written
+    ones. Within a refresh cycle the writes are collected and every entity
+    is written once when the cycle ends. Cycles are kept per thread, so a
+    cycle only defers the writes of its own thread. A cycle must not be
+    held open across a call to iCloud.
+    """
+    def __init__(self):
+        self.written = 0
+        self.skipped = 0
+        self._local = threading.local()
+
+    def _cycles(self):
+        """ Returns the cycle state of the current thread """
+        local = self._local
+        if not hasattr(local, 'depth'):
+            local.depth = 0
+            local.pending = collections.OrderedDict()
+        return local
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """ Coalesces the writes until the outermost cycle ends """
+        local = self._cycles()
+        local.depth += 1
+        try:
+            yield
+        finally:
+            local.depth -= 1
+            if local.depth == 0 and local.pending:
+                pending = local.pending
+                local.pending = collections.OrderedDict()
+                for entity in pending.values():
+                    self.write_now(entity)
+
+    def write(self, entity):
+        """ Writes the state of an entity or defers it to the cycle end """
+        local = self._cycles()
+        if local.depth:
+            local.pending[entity.entity_id] = entity
+            return
+        self.write_now(entity)
+
+    def write_now(self, entity):
+        """ Writes the state of an entity if it changed """
+        written = (entity.state, entity.state_attributes)
+        if written == entity.written_state:
+            self.skipped += 1
+            return
+        entity.written_state = written
+        self.written += 1
+        if entity.stats is not None:
+            with entity.stats.timed(STATS_WRITE):
+                Entity.update_ha_state(entity)
+        else:
+            Entity.update_ha_state(entity)
+
+    def remove(self, entity):
+        """ Removes the state of an entity """
+        self._cycles().pending.pop(entity.entity_id, None)
+        entity.written_state = None
+        entity.hass.states.remove(entity.entity_id)
+
+STATE_WRITES = IcloudStateWriter()
+
+
+class IcloudEntity(Entity):
+    """ Entity whose state is only written when it changed. """
+    written_state = None
+    stats = None
+
+    def update_ha_state(self, force_refresh=False):
+        """ Writes the state through the state writer """
+        STATE_WRITES.write(self)
+
+
+class TickClock(object):
+    """ One reading of the clock shared by everything done in a tick.
+
+    The local time is computed once per distinct time zone.
+    """
+    def __init__(self, epoch=None):
+        self.epoch = time.time() if epoch is None else epoch
+        self._nows = {}
+
+    def now(self, tz=None):
+        """ Returns the time of the tick in a time zone """
+        tz = tz or dt_util.DEFAULT_TIME_ZONE
+        if tz not in self._nows:
+            self._nows[tz] = datetime.fromtimestamp(self.epoch, tz)
+        return self._nows[tz]
+
+class ICalendarCache(object):
+    """ Caches the events of the calendar of an account.
+
+    The events are fetched again after the refresh time, between fetches
+    the event entities count down from the cache.
+    """
+    def __init__(self, refresh=DEFAULT_CALENDAR_REFRESH):
+        self.refresh = refresh
+        self.events = collections.OrderedDict()
+        self.times = {}
+        self.zones = {}
+        self.fetches = 0
+        self._fetched = None
+
+    def expired(self):
+        """ Returns True if the events have to be fetched again """
+        return (self._fetched is None or
+                time.time() - self._fetched >= self.refresh * 60)
+
+    def invalidate(self):
+        """ Fetches the events again on the next update """
+        self._fetched = None
+
+    def update(self, events):
+        """ Replaces the cached events, returns the added, changed and
+        removed guids.
+
+        The events are kept sorted by start time. An unchanged event keeps
+        its cached dict, so a changed event is a different object. Start
+        and end are parsed to epoch seconds once, when an event comes in.
+        """
+        new_events = collections.OrderedDict()
+        for event in sorted(events, key=lambda event: event['startDate']):
+            new_events[event['guid']] = event
+        added = set(new_events) - set(self.events)
+        removed = set(self.events) - set(new_events)
+        changed = set()
+        for guid in set(new_events) & set(self.events):
+            if ([new_events[guid].get(field) for field in CALENDAR_FIELDS] !=
+                    [self.events[guid].get(field)
+                     for field in CALENDAR_FIELDS]):
+                changed.add(guid)
+            else:
+                new_events[guid] = self.events[guid]
+        for guid in removed:
+            del self.times[guid]
+            del self.zones[guid]
+        for guid in added | changed:
+            event = new_events[guid]
+            tz = get_timezone(event['tz'])
+            self.zones[guid] = tz
+            self.times[guid] = (event_timestamp(event['startDate'], tz),
+                                event_timestamp(event['endDate'], tz))
+        self.events = new_events
+        self.fetches += 1
+        self._fetched = time.time()
+        return added, changed, removed
+
+class IFleetTable(object):
+    """ Keeps the hot data of all devices in columns of packed arrays.
+
+    Every IDevice owns a row. A value takes eight bytes in its column
+    instead of an attribute in the dict of the entity; None is kept as NaN
+    and a status code as its index in the codes of the table.
+    """
+    def __init__(self, columns=FLEET_COLUMNS):
+        self.columns = {column: array.array('d') for column in columns}
+        self.codes = list(DEVICE_STATUSES)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns[FLEET_COLUMNS[0]])
+
+    def allocate(self):
+        """ Adds a row of unset values and returns its index """
+        with self._lock:
+            for column in self.columns.values():
+                column.append(NAN)
+            return len(self) - 1
+
+    def get(self, column, row):
+        """ Returns a value, None if it isn't set """
+        value = self.columns[column][row]
+        return None if value != value else value
+
+    def set(self, column, row, value):
+        """ Sets a value, None unsets it """
+        self.columns[column][row] = NAN if value is None else value
+
+    def code(self, row):
+        """ Returns the status code of a row """
+        index = self.get(FLEET_STATUS, row)
+        return None if index is None else self.codes[int(index)]
+
+    def set_code(self, row, code):
+        """ Sets the status code of a row """
+        if code is None:
+            self.set(FLEET_STATUS, row, None)
+            return
+        with self._lock:
+            if code not in self.codes:
+                self.codes.append(code)
+            index = self.codes.index(code)
+        self.set(FLEET_STATUS, row, index)
+
+FLEET_TABLE = IFleetTable()
+
+
+class IFleetColumn(object):
+    """ Attribute of an IDevice that lives in a column of the fleet table """
+    def __init__(self, column, integral=False):
+        self.column = column
+        self.integral = integral
+
+    def __get__(self, idevice, owner):
+        if idevice is None:
+            return self
+        value = FLEET_TABLE.get(self.column, idevice.row)
+        if self.integral and value is not None and value.is_integer():
+            return int(value)
+        return value
+
+    def __set__(self, idevice, value):
+        FLEET_TABLE.set(self.column, idevice.row, value)
+
+
+class IFixHistory(object):
+    """ Ring buffer of the recent fixes of a device.
+
+    Every fix is a packed record of timestamp, latitude, longitude,
+    accuracy and battery, written over the oldest one once the buffer is
+    full, so an append is O(1) and the memory is fixed. With a path the
+    buffer is a memory-mapped file and the fixes survive a restart.
+    """
+    def __init__(self, size=DEFAULT_HISTORY_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        length = HISTORY_HEADER.size + size * HISTORY_RECORD.size
+        if path is None:
+            self._buffer = bytearray(length)
+        else:
+            self._buffer = self._map(path, length)
+        magic, size, self._head, self._count = HISTORY_HEADER.unpack_from(
+            self._buffer, 0)
+        if magic != HISTORY_MAGIC or size != self.size:
+            self._head = self._count = 0
+            self._write_header()
+
+    def _map(self, path, length):
+        """ Maps the file of the buffer, creating it if needed """
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        self._file = open(path, mode)
+        if os.fstat(self._file.fileno()).st_size != length:
+            # a new file, or one of another size, starts empty
+            self._file.truncate(0)
+            self._file.truncate(length)
+        return mmap.mmap(self._file.fileno(), length)
+
+    def _write_header(self):
+        """ Writes the position of the buffer """
+        HISTORY_HEADER.pack_into(self._buffer, 0, HISTORY_MAGIC, self.size,
+                                 self._head, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, latitude, longitude, accuracy=None,
+               battery=None):
+        """ Adds a fix, dropping the oldest one if the buffer is full """
+        with self._lock:
+            HISTORY_RECORD.pack_into(
+                self._buffer,
+                HISTORY_HEADER.size + self._head * HISTORY_RECORD.size,
+                timestamp, latitude, longitude,
+                NAN if accuracy is None else accuracy,
+                NAN if battery is None else battery)
+            self._head = (self._head + 1) % self.size
+            self._count = min(self.size, self._count + 1)
+            self._write_header()
+
+    def last(self, count=None):
+        """ Returns the newest fixes, oldest first """
+        with self._lock:
+            count = self._count if count is None else min(count, self._count)
+            fixes = []
+            for index in range(self._head - count, self._head):
+                fix = HISTORY_RECORD.unpack_from(
+                    self._buffer, HISTORY_HEADER.size +
+                    (index % self.size) * HISTORY_RECORD.size)
+                fixes.append(tuple(None if value != value else value
+                                   for value in fix))
+            return fixes
+
+    def close(self):
+        """ Writes a mapped buffer to its file and closes it """
+        with self._lock:
+            if self._file is not None:
+                length = len(self._buffer)
+                self._buffer.flush()
+                self._buffer.close()
+                self._file.close()
+                self._file = None
+                # fixes added after the close are kept in memory
+                self._buffer = bytearray(length)
+                self._head = self._count = 0
+                self._write_header()
+
+
+class IDevice(IcloudEntity):  # pylint: disable=too-many-instance-attributes
     """ Represents a Proximity in Home Assistant. """
+    _interval = IFleetColumn(FLEET_INTERVAL, integral=True)
+    _lastpoll = IFleetColumn(FLEET_LASTPOLL)
+    _battery = IFleetColumn(FLEET_BATTERY)
+    _distance = IFleetColumn(FLEET_DISTANCE)
+    _zonedistance = IFleetColumn(FLEET_ZONEDISTANCE)
+    _fixzonedistance = IFleetColumn(FLEET_FIXZONEDISTANCE)
+    _homedistance = IFleetColumn(FLEET_HOMEDISTANCE)
+    _speed = IFleetColumn(FLEET_SPEED)
+    _seeforwarded = IFleetColumn(FLEET_SEEFORWARDED, integral=True)
+    _seesuppressed = IFleetColumn(FLEET_SEESUPPRESSED, integral=True)
+    _refinestart = IFleetColumn(FLEET_REFINESTART)
+    _refining = IFleetColumn(FLEET_REFINING, integral=True)
+    _min_horizontal_accuracy = MIN_HORIZONTAL_ACCURACY
+
     def __init__(self, hass, icloudobject, name, identifier):
         # pylint: disable=too-many-arguments
         self.hass = hass
         self.icloudobject = icloudobject
         self.devicename = name
         self.identifier = identifier
-        self._request_interval_seconds = 60
+        self.stats = icloudobject.stats
+        self.row = FLEET_TABLE.allocate()
+        self.history = IFixHistory(icloudobject.historysize,
+                                   icloudobject.history_path(name))
         self._interval = 1
-        self.api = icloudobject.api
+        self._lastpoll = None
         self._distance = None
         self._battery = None
         self._overridestate = None
-        self._devicestatuscode = None
-        self._devicestatus = None
         self._lowPowerMode = None
         self._batteryStatus = None
+        self._nearestzone = None
+        self._zonedistance = None
+        self._proximityfix = None
+        self._fixzonedistance = None
+        self._homedistance = None
+        self._seeforwarded = 0
+        self._seesuppressed = 0
+        self._speed = None
+        self._refinestart = None
+        self._refining = 0
         
         self.entity_id = generate_entity_id(
             ENTITY_ID_FORMAT_DEVICE, self.devicename,
@@ -225,6 +1651,39 @@ class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
         """ Unit of measurement of this entity """
         return "minutes"
 
+    @property
+    def api(self):
+        """ Returns the api of the account """
+        return self.icloudobject.api
+
+    @property
+    def _devicestatuscode(self):
+        """ Returns the status code iCloud reported last """
+        return FLEET_TABLE.code(self.row)
+
+    @_devicestatuscode.setter
+    def _devicestatuscode(self, code):
+        FLEET_TABLE.set_code(self.row, code)
+
+    @property
+    def _devicestatus(self):
+        """ Returns the device status of the status code """
+        code = self._devicestatuscode
+        if code is None:
+            return None
+        return DEVICE_STATUSES.get(code, DEVICE_STATUS_ERROR)
+
+    @property
+    def _lastfix(self):
+        """ Returns the last fix passed on to the device tracker """
+        fix = tuple(FLEET_TABLE.get(column, self.row) for column in FLEET_FIX)
+        return None if fix[-1] is None else fix
+
+    @_lastfix.setter
+    def _lastfix(self, fix):
+        for column, value in zip(FLEET_FIX, fix or [None] * len(FLEET_FIX)):
+            FLEET_TABLE.set(column, self.row, value)
+
     @property
     def state_attributes(self):
         """ returns the friendlyname of the icloud tracker """
@@ -232,9 +1691,15 @@ class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
             ATTR_DEVICENAME: self.devicename,
             ATTR_BATTERY: self._battery,
             ATTR_DISTANCE: self._distance,
+            ATTR_NEARESTZONE: self._nearestzone,
+            ATTR_ZONEDISTANCE: self._zonedistance,
             ATTR_DEVICESTATUS: self._devicestatus,
             ATTR_LOWPOWERMODE: self._lowPowerMode,
-            ATTR_BATTERYSTATUS: self._batteryStatus
+            ATTR_BATTERYSTATUS: self._batteryStatus,
+            ATTR_SEEFORWARDED: self._seeforwarded,
+            ATTR_SEESUPPRESSED: self._seesuppressed,
+            ATTR_SPEED: self._speed,
+            ATTR_REFINING: self._refining
         }
         
     @property
@@ -242,59 +1707,124 @@ class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
         """Return the icon to use for device if any."""
         return 'mdi:cellphone-iphone'
         
-    def keep_alive(self):
-        """ Keeps the api alive """
-        currentminutes = dt_util.now().hour * 60 + dt_util.now().minute
-        maxminute = round(self._interval / 5, 0)
-        if currentminutes % self._interval <= maxminute:
-            self.update_icloud(see)
+    def interval_seconds(self):
+        """ Returns the interval between two polls in seconds """
+        return self._interval * 60
+
+    def next_poll(self):
+        """ Returns the time the device is due for its next poll """
+        if self._lastpoll is None:
+            return time.time()
+        return self._lastpoll + self.interval_seconds()
+
+    def poll_tolerance(self):
+        """ Returns how many seconds early the device may be polled """
+        return self.interval_seconds() / 5
 
     def lost_iphone(self):
         """ Calls the lost iphone function if the device is found """
+        ENGINE.run(self.async_lost_iphone())
+
+    async def async_lost_iphone(self):
+        """ Plays a sound on the device """
         if self.api is not None:
-            self.api.authenticate()
-            self.identifier.play_sound()
+            await self.icloudobject.async_call(STATS_SOUND,
+                                               self.identifier.play_sound,
+                                               priority=PRIORITY_USER)
+
+    def is_near(self):
+        """ Returns True if the device is close to a zone """
+        return (self._fixzonedistance is not None and
+                self._fixzonedistance <= NEAR_ZONE_DISTANCE)
 
     def data_is_accurate(self, data):
+        """ Returns True if a location is finished and accurate enough """
         if not data:
             return False
         elif not data['locationFinished']:
             return False
-        # elif data['isInaccurate']:
-        #     return False
+        elif data.get('isInaccurate'):
+            return False
         # elif data['isOld']:
         #     return False
-        # elif data['horizontalAccuracy'] > self._min_horizontal_accuracy:
-        #    return False
+        elif ((data.get('horizontalAccuracy') or 0) >
+              self._min_horizontal_accuracy):
+            return False
         return True
 
-    def update_icloud(self, see):
-        """ Authenticate against iCloud and scan for devices. """        
+    def fix_is_final(self, location):
+        """ Returns True if a fix may go to the device tracker.
+
+        An inaccurate fix is refined: the device is polled again after the
+        request interval of the account until the fix is accurate or the
+        account's maximum wait has passed, then the last fix is final.
+        """
+        if self.data_is_accurate(location):
+            self._refinestart = None
+            return True
+        now = time.time()
+        if self._refinestart is None:
+            self._refinestart = now
+        if now - self._refinestart >= self.icloudobject._max_wait_seconds:
+            _LOGGER.debug("No accurate fix of %s within %s seconds, using "
+                          "the last one", self.devicename,
+                          self.icloudobject._max_wait_seconds)
+            self._refinestart = None
+            return True
+        return False
+
+    def update_icloud(self, see, status=None):
+        """ Updates the device from a snapshot of the fleet of the account. """
+        if status is None and self.api is not None:
+            fleet = self.icloudobject.refresh_fleet(
+                FLEET_MAX_AGE, devicenames=[self.devicename])
+            status = fleet.get(self.devicename)
+        self.update_status(see, status)
+
+    def update_status(self, see, status):
+        """ Updates the device from its status and passes its location on """
         if self.api is not None:
             from pyicloud.exceptions import PyiCloudNoDevicesException
 
             try:
-                # Loop through every device registered with the iCloud account
-                status = self.identifier.status(DEVICESTATUSSET)
-                dev_id = re.sub(r"(\s|\W|')", '',
-                                status['name']).lower()
+                if status is None:
+                    _LOGGER.error("devicename %s not found in account %s",
+                                  self.devicename,
+                                  self.icloudobject.accountname)
+                    return
+                self._lastpoll = time.time()
+                dev_id = devicename_from(status['name'])
                 self._devicestatuscode = status['deviceStatus']
-                if self._devicestatuscode == '200':
-                    self._devicestatus = 'online'
-                elif self._devicestatuscode == '201':
-                    self._devicestatus = 'offline'
-                elif self._devicestatuscode == '203':
-                    self._devicestatus = 'pending'
-                elif self._devicestatuscode == '204':
-                    self._devicestatus = 'unregistered'
-                else:
-                    self._devicestatus = 'error'
                 self._lowPowerMode = status['lowPowerMode']
                 self._batteryStatus = status['batteryStatus']
                 self.update_ha_state()
                 battery = status['batteryLevel']*100
                 location = status['location']
+                if location and not self.fix_is_final(location):
+                    # poll again soon, without blocking the other devices
+                    self._refining += 1
+                    SCHEDULER.schedule(
+                        self, time.time() +
+                        self.icloudobject._request_interval_seconds)
+                    return
                 if location:
+                    self.add_fix(location, battery)
+                if (location and self._overridestate is None and
+                        self._fixzonedistance is not None and
+                        self.tracker_state() == 'not_home'):
+                    # away from the zones the interval follows every fix,
+                    # also the ones not passed on to the device tracker
+                    self._interval = self.adaptive_interval(
+                        self._fixzonedistance)
+                    self.update_ha_state()
+                if location and self.fix_is_redundant(location, battery):
+                    self._seesuppressed += 1
+                elif location:
+                    self._seeforwarded += 1
+                    self._lastfix = (location['latitude'],
+                                     location['longitude'],
+                                     location['horizontalAccuracy'],
+                                     battery, time.time())
                     see(
                         hass=self.hass,
                         dev_id=dev_id,
@@ -304,39 +1834,141 @@ class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
                         battery=battery,
                         gps_accuracy=location['horizontalAccuracy']
                     )
+                SCHEDULER.schedule(self)
             except PyiCloudNoDevicesException:
                 _LOGGER.error('No iCloud Devices found!')
                 
+    def add_fix(self, location, battery):
+        """ Adds a fix to the history unless it is the last one again """
+        timestamp = location.get('timeStamp')
+        timestamp = (timestamp / 1000 if timestamp is not None
+                     else time.time())
+        last = self.history.last(1)
+        if last and last[0][0] == timestamp:
+            return
+        self.history.append(timestamp, location['latitude'],
+                            location['longitude'],
+                            location.get('horizontalAccuracy'), battery)
+
+    def fix_is_redundant(self, location, battery):
+        """ Returns True if the fix doesn't have to go to the tracker.
+
+        That is when the device didn't move further than the movement
+        threshold of the account, the battery didn't change and the last
+        forwarded fix is younger than the heartbeat.
+        """
+        threshold = self.icloudobject.movementthreshold
+        if threshold is None or self._lastfix is None:
+            return False
+        latitude, longitude, accuracy, lastbattery, forwarded = self._lastfix
+        if battery != lastbattery:
+            return False
+        if time.time() - forwarded >= self.icloudobject.heartbeat * 60:
+            return False
+        if threshold == THRESHOLD_ACCURACY:
+            threshold = accuracy or 0
+        return distance(location['latitude'], location['longitude'],
+                        latitude, longitude) <= threshold
+
+    def set_proximity(self, fix, proximity):
+        """ Keeps the nearest zone and the distances of a fix """
+        self._proximityfix = fix
+        zone, self._fixzonedistance, self._homedistance = proximity
+        self._nearestzone = (zone[len('zone.'):] if zone is not None
+                             else None)
+
+    def estimate_speed(self):
+        """ Returns the speed in m/s over the recent fixes, None without
+        enough fixes. Movement within the accuracy of the fixes counts as
+        standing still. """
+        # a device polled at the maximum interval keeps an estimate
+        window = max(SPEED_WINDOW, 2 * self.icloudobject.maxinterval) * 60
+        fixes = [fix for fix in self.history.last(SPEED_FIXES)
+                 if time.time() - fix[0] <= window]
+        if len(fixes) < 2 or fixes[-1][0] <= fixes[0][0]:
+            return None
+        first, last = fixes[0], fixes[-1]
+        moved = haversine(first[1], first[2], last[1], last[2])
+        moved -= max(first[3] or 0, last[3] or 0)
+        return max(0, moved) / (last[0] - first[0])
+
+    def adaptive_interval(self, zonedistance):
+        """ Returns the minutes until the next poll for a device away from
+        the zones.
+
+        A moving device is polled a few times before it can reach the
+        nearest zone at its current speed, a device that stands still
+        only at the maximum interval. Without a speed estimate the device
+        keeps the interval of its last one, or the interval follows from
+        the distance alone if it had none since it left a zone. A low
+        battery doubles the interval far from a zone.
+        """
+        speed = self.estimate_speed()
+        if speed is None and self._speed is not None:
+            return self._interval
+        self._speed = None if speed is None else round(speed * 3.6, 1)
+        minimum = self.icloudobject.mininterval
+        maximum = self.icloudobject.maxinterval
+        if speed is None:
+            if zonedistance > 100:
+                interval = round((zonedistance / 60), 0)
+            elif zonedistance > 50:
+                interval = 30
+            elif zonedistance > 25:
+                interval = 15
+            elif zonedistance > 10:
+                interval = 5
+            else:
+                interval = 1
+        elif speed < STATIONARY_SPEED:
+            interval = maximum
+        else:
+            # minutes until the device reaches the edge of the zone
+            eta = zonedistance * 1000 / speed / 60
+            interval = round(eta * ETA_FRACTION)
+        if self._battery is not None:
+            if self._battery <= 33 and zonedistance > 3:
+                interval = interval * 2
+        return max(minimum, min(maximum, interval))
+
+    def tracker_state(self):
+        """ Returns the state of the device tracker of the device """
+        devicestate = self.hass.states.get('device_tracker.' +
+                                           self.devicename)
+        return None if devicestate is None else devicestate.state
+
     def get_default_interval(self):
         devid = 'device_tracker.' + self.devicename
         devicestate = self.hass.states.get(devid)
-        self.devicechanged(self.devicename, None, devicestate)
+        if devicestate is not None:
+            self.devicechanged(self.devicename, None, devicestate)
                 
     def setinterval(self, interval=None):
         if interval is not None:
             devid = 'device_tracker.' + self.devicename
             devicestate = self.hass.states.get(devid)
-            self._overridestate = devicestate.state
-            self._interval = interval
+            if devicestate is not None:
+                self._overridestate = devicestate.state
+            self._interval = float(interval)
         else:
             self.get_default_interval()
         self.update_ha_state()
-        update_icloud(see)
+        SCHEDULER.schedule(self)
       
     def devicechanged(self, entity, old_state, new_state):
         if entity is None:
             return
             
         self._distance = None
+        self._zonedistance = None
         if 'latitude' in new_state.attributes:
-            device_state_lat = new_state.attributes['latitude']
-            device_state_long = new_state.attributes['longitude']
-            zone_state = self.hass.states.get('zone.home')
-            zone_state_lat = zone_state.attributes['latitude']
-            zone_state_long = zone_state.attributes['longitude']
-            self._distance = distance(device_state_lat, device_state_long,
-                                      zone_state_lat, zone_state_long)
-            self._distance = round(self._distance / 1000, 1)
+            fix = (new_state.attributes['latitude'],
+                   new_state.attributes['longitude'])
+            if fix != self._proximityfix:
+                # not located by the last fleet refresh
+                self.set_proximity(fix, PROXIMITY.nearest([fix])[0])
+            self._distance = self._homedistance
+            self._zonedistance = self._fixzonedistance
         if 'battery' in new_state.attributes:
             self._battery = new_state.attributes['battery']
             
@@ -348,32 +1980,29 @@ class IDevice(Entity):  # pylint: disable=too-many-instance-attributes
         
         if new_state.state != 'not_home':
             self._interval = 30
+            # the next trip starts without a speed estimate
+            self._speed = None
             self.update_ha_state()
+            SCHEDULER.schedule(self)
         else:
-            if self._distance is None:
+            # the distance to the edge of the nearest zone, not only home
+            zonedistance = self._zonedistance
+            if zonedistance is None:
+                zonedistance = self._distance
+            if zonedistance is None:
                 self.update_ha_state()
                 return
-            if self._distance > 100:
-                self._interval = round((self._distance / 60), 0)
-            elif self._distance > 50:
-                self._interval = 30
-            elif self._distance > 25:
-                self._interval = 15
-            elif self._distance > 10:
-                self._interval = 5
-            else:
-                self._interval = 1
-            if self._battery is not None:
-                if self._battery <= 33 and self._distance > 3:
-                    self._interval = self._interval * 2
+            self._interval = self.adaptive_interval(zonedistance)
             self.update_ha_state()
+            SCHEDULER.schedule(self)
 
-class IEvent(Entity):  # pylint: disable=too-many-instance-attributes
+class IEvent(IcloudEntity):  # pylint: disable=too-many-instance-attributes
     """ Represents a Proximity in Home Assistant. """
     def __init__(self, hass, icloudobject, name, type=None):
         # pylint: disable=too-many-arguments
         self.hass = hass
         self.icloudobject = icloudobject
+        self.stats = icloudobject.stats
         self.api = icloudobject.api
         self.eventguid = name
         self._starttime = None
@@ -387,6 +2016,7 @@ class IEvent(Entity):  # pylint: disable=too-many-instance-attributes
         self._location = None
         self._type = type
         self._tz = None
+        self.event = None
         
         self.entity_id = generate_entity_id(
             ENTITY_ID_FORMAT_EVENT, self.eventguid,
@@ -417,140 +2047,103 @@ class IEvent(Entity):  # pylint: disable=too-many-instance-attributes
         elif self._type == TYPE_NEXT:
             return 'mdi:calendar-clock'
         
-    def keep_alive(self, starttime, endtime, duration, title, tz, location):
-        """ Keeps the api alive """
-        current = self._type == TYPE_CURRENT
-        nextev = self._type == TYPE_NEXT
-        self._remaining = 0
-        tempnow = dt_util.now(tz)
-        if tz is None:
-            self._tz = pytz.utc
-        else:
-            self._tz = tz
-        
-        if starttime is None:
-            self._starttime = None
-            self._starttext = None
-        else:
-            self._starttime = datetime(starttime[1], starttime[2],
-                                       starttime[3], starttime[4],
-                                       starttime[5], 0, 0, self._tz)
-            self._starttext = self._starttime.strftime("%A %d %B %Y %H.%M.%S")
-            if nextev:
-                self._remaining = self._starttime - tempnow
-                remainingdays = self._remaining.days
-                remainingseconds = (self._starttime.hour * 3600 +
-                                    self._starttime.minute * 60 +
-                                    self._starttime.second -
-                                    tempnow.hour * 3600 -
-                                    tempnow.minute * 60 -
-                                    tempnow.second)
-                if ((self._starttime.year > tempnow.year or
-                    self._starttime.month > tempnow.month or
-                    self._starttime.day > tempnow.day) and
-                    remainingseconds < 0):
-                    remainingseconds = 86400 + remainingseconds
-                self._remaining = (remainingdays * 1440 +
-                                   round(remainingseconds / 60, 0))
-        if endtime is None:
-            self._endtime = None
-            self._endtext = None
-        else:
-            self._endtime = datetime(endtime[1], endtime[2], endtime[3],
-                                     endtime[4], endtime[5], 0, 0,
-                                     self._tz)
-            self._endtext = self._endtime.strftime("%A %d %B %Y %H.%M.%S")
-            if current:
-                self._remaining = self._endtime - tempnow
-                remainingdays = self._remaining.days
-                remainingseconds = (self._endtime.hour * 3600 +
-                                    self._endtime.minute * 60 +
-                                    self._endtime.second -
-                                    tempnow.hour * 3600 -
-                                    tempnow.minute * 60 -
-                                    tempnow.second)
-                if ((self._endtime.year > tempnow.year or
-                    self._endtime.month > tempnow.month or
-                    self._endtime.day > tempnow.day) and
-                    remainingseconds < 0):
-                    remainingseconds = 86400 + remainingseconds
-                self._remaining = (remainingdays * 1440 +
-                                   round(remainingseconds / 60, 0))
+    def keep_alive(self, starttime, endtime, duration, title, tz, location,
+                   clock):
+        """ Updates the event, start and end are epoch seconds """
+        self._tz = pytz.utc if tz is None else tz
+        self._starttime = starttime
+        self._endtime = endtime
+        self._starttext = None
+        if starttime is not None:
+            self._starttext = datetime.fromtimestamp(
+                starttime, self._tz).strftime("%A %d %B %Y %H.%M.%S")
+        self._endtext = None
+        if endtime is not None:
+            self._endtext = datetime.fromtimestamp(
+                endtime, self._tz).strftime("%A %d %B %Y %H.%M.%S")
         self._duration = duration
         self._title = title
-        if (current or nextev) and title is None:
+        if self._type in (TYPE_CURRENT, TYPE_NEXT) and title is None:
             self._title = 'Free'
         self._location = location
-        
-        tempdays = floor(self._remaining / 1440)
-        temphours = floor((self._remaining % 1440) / 60)
-        tempminutes = floor(self._remaining % 60)
-        self._remainingtext = (str(tempdays) + "d " +
-                               str(temphours) + "h " +
-                               str(tempminutes) + "m")
-        
-        if self._remaining <= 0:
-            self.hass.states.remove(self.entity_id)
-        else:
-            self.update_ha_state()
+        self.check_alive(clock)
     
-    def check_alive(self):
-        """ Keeps the api alive """
-        current = self._type == TYPE_CURRENT
-        nextev = self._type == TYPE_NEXT
-        self._remaining = 0
-        tempnow = dt_util.now(self._tz)
-        if self._starttime is not None:
-            if nextev:
-                self._remaining = self._starttime - tempnow
-                remainingdays = self._remaining.days
-                remainingseconds = (self._starttime.hour * 3600 +
-                                    self._starttime.minute * 60 +
-                                    self._starttime.second -
-                                    tempnow.hour * 3600 -
-                                    tempnow.minute * 60 -
-                                    tempnow.second)
-                if ((self._starttime.year > tempnow.year or
-                    self._starttime.month > tempnow.month or
-                    self._starttime.day > tempnow.day) and
-                    remainingseconds < 0):
-                    remainingseconds = 86400 + remainingseconds
-                self._remaining = (remainingdays * 1440 +
-                                   round(remainingseconds / 60, 0))
-        if self._endtime is not None:
-            if current:
-                self._remaining = self._endtime - tempnow
-                remainingdays = self._remaining.days
-                remainingseconds = (self._endtime.hour * 3600 +
-                                    self._endtime.minute * 60 +
-                                    self._endtime.second -
-                                    tempnow.hour * 3600 -
-                                    tempnow.minute * 60 -
-                                    tempnow.second)
-                if ((self._endtime.year > tempnow.year or
-                    self._endtime.month > tempnow.month or
-                    self._endtime.day > tempnow.day) and
-                    remainingseconds < 0):
-                    remainingseconds = 86400 + remainingseconds
-                self._remaining = (remainingdays * 1440 +
-                                   round(remainingseconds / 60, 0))
-                                   
-        tempdays = floor(self._remaining / 1440)
-        temphours = floor((self._remaining % 1440) / 60)
-        tempminutes = floor(self._remaining % 60)
-        self._remainingtext = (str(tempdays) + "d " +
-                               str(temphours) + "h " +
-                               str(tempminutes) + "m")
+    def check_alive(self, clock):
+        """ Counts down to the start or the end of the event """
+        target = None
+        if self._type == TYPE_NEXT:
+            target = self._starttime
+        elif self._type == TYPE_CURRENT:
+            target = self._endtime
+        remaining = 0
+        if target is not None:
+            # whole minutes, rounded up so the event ends on time
+            remaining = int(-((clock.epoch - target) // 60))
+        if remaining != self._remaining or self._remainingtext is None:
+            self._remaining = remaining
+            self._remainingtext = "%dd %dh %dm" % (remaining // 1440,
+                                                   remaining % 1440 // 60,
+                                                   remaining % 60)
 
         if self._remaining <= 0:
-            self.hass.states.remove(self.entity_id)
+            STATE_WRITES.remove(self)
         else:
             self.update_ha_state()
 
-class Icloud(Entity):  # pylint: disable=too-many-instance-attributes
+class ISnapshotCache(object):
+    """ The last status of every device of an account, by device id.
+
+    Each status has the time of the refresh that brought it and the
+    profile of its fields. A caller that accepts a status of a certain
+    age gets it from here, a hit, instead of from a refresh, a miss.
+    """
+    def __init__(self):
+        self.snapshots = {}
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, statuses, profile):
+        """ Stores the statuses of a refresh by devicename """
+        updated = time.time()
+        for devicename, status in statuses.items():
+            identifier = status.get('id', devicename)
+            self.ids[devicename] = identifier
+            self.snapshots[identifier] = (updated, profile, status)
+
+    def fleet(self, max_age, profile, devicenames=None):
+        """ Returns the statuses of the devices, None if one of them is
+        older than max_age seconds or lacks the fields of the profile """
+        devicenames = list(self.ids) if devicenames is None else devicenames
+        if not devicenames:
+            return None
+        now = time.time()
+        fleet = {}
+        for devicename in devicenames:
+            snapshot = self.snapshots.get(self.ids.get(devicename))
+            if (snapshot is None or now - snapshot[0] > max_age or
+                    snapshot[1] not in (profile, PROFILE_FULL)):
+                return None
+            fleet[devicename] = snapshot[2]
+        return fleet
+
+    @property
+    def hit_rate(self):
+        """ Returns the percentage of requests served from the cache """
+        requests = self.hits + self.misses
+        return round(100.0 * self.hits / requests, 1) if requests else None
+
+
+class Icloud(IcloudEntity):  # pylint: disable=too-many-instance-attributes
     """ Represents a Proximity in Home Assistant. """
     def __init__(self, hass, username, password, name, ignored_devices,
-                 getevents):
+                 getevents, calendarrefresh=DEFAULT_CALENDAR_REFRESH,
+                 movementthreshold=DEFAULT_MOVEMENT_THRESHOLD,
+                 heartbeat=DEFAULT_HEARTBEAT,
+                 historysize=DEFAULT_HISTORY_SIZE,
+                 historystore=DEFAULT_HISTORY_STORE,
+                 mininterval=DEFAULT_MIN_INTERVAL,
+                 maxinterval=DEFAULT_MAX_INTERVAL):
         # pylint: disable=too-many-arguments
         self.hass = hass
         self.username = username
@@ -560,153 +2153,118 @@ class Icloud(Entity):  # pylint: disable=too-many-instance-attributes
         self._request_interval_seconds = 10
         self._interval = 1
         self.api = None
+        self.session = None
+        self.stats = IcloudStats()
+        self.breaker = ICircuitBreaker()
         self.devices = {}
         self.getevents = getevents
+        self.calendar = ICalendarCache(calendarrefresh)
+        self.movementthreshold = movementthreshold
+        self.heartbeat = heartbeat
+        self.historysize = historysize
+        self.historystore = historystore
+        self.mininterval = mininterval
+        self.maxinterval = maxinterval
         self.events = {}
         self.currentevents = {}
         self.nextevents = {}
         self._ignored_devices = ignored_devices
         self._ignored_identifiers = {}
+        self._devicemanager = None
+        self.snapshots = ISnapshotCache()
+        self._fleet_refresh = None
+        self._startuptime = None
+        self._discovered = False
+        self.ready = threading.Event()
+        self._store = ISessionStore(hass.config.path(SESSION_STORE),
+                                    self.username or self.accountname)
         
         self.entity_id = generate_entity_id(
             ENTITY_ID_FORMAT_ICLOUD, self.accountname,
             hass=self.hass)
 
-        if self.username is None or self.password is None:
-            _LOGGER.error('Must specify a username and password')
-        else:
+    def start(self):
+        """ Logs in, discovers the devices and loads the calendar """
+        ENGINE.run(self.async_start())
+
+    async def async_start(self):
+        """ Starts the account in the background of the setup """
+        initstart = time.time()
+        try:
+            if self.username is None or self.password is None:
+                _LOGGER.error('Must specify a username and password')
+                return
             try:
-                # Attempt the login to iCloud
-                self.api = PyiCloudService(self.username,
-                                           self.password,
-                                           verify=True)
-                for device in self.api.devices:
-                    status = device.status(DEVICESTATUSSET)
-                    devicename = re.sub(r"(\s|\W|')", '',
-                                        status['name']).lower()
-                    if (devicename not in self.devices and
-                        devicename not in self._ignored_devices):
-                        idevice = IDevice(self.hass, self, devicename, device)
-                        idevice.update_ha_state()
-                        self.devices[devicename] = idevice
-                    elif devicename in self._ignored_devices:
-                        self._ignored_identifiers[devicename] = device
-                    
-                if self.getevents:
-                    from_dt = dt_util.now()
-                    to_dt = from_dt + timedelta(days=7)
-                    events = self.api.calendar.events(from_dt, to_dt)
-                    new_events = sorted(events.list_of_dict, key=operator.attrgetter('startDate'))
-                    starttime = None
-                    endtime = None
-                    duration = None
-                    title = None
-                    tz = pytz.utc
-                    location = None
-                    guid = None
-                    for event in new_events:
-                        tz = event['tz']
-                        if tz is None:
-                            tz = pytz.utc
-                        else:
-                            tz = timezone(tz)
-                        tempnow = dt_util.now(tz)
-                        guid = event['guid']
-                        starttime = event['startDate']
-                        startdate = datetime(starttime[1], starttime[2],
-                                             starttime[3], starttime[4],
-                                             starttime[5], 0, 0, tz)
-                        endtime = event['endDate']
-                        enddate = datetime(endtime[1], endtime[2], endtime[3],
-                                           endtime[4], endtime[5], 0, 0, tz)
-                        duration = event['duration']
-                        title = event['title']
-                        location = event['location']
-                        
-                        strnow = tempnow.strftime("%Y%m%d%H%M%S")
-                        strstart = startdate.strftime("%Y%m%d%H%M%S")
-                        strend = enddate.strftime("%Y%m%d%H%M%S")
-                        
-                        if strnow > strstart and strend > strnow:
-                            ievent = IEvent(self.hass, self, guid,
-                                            TYPE_CURRENT)
-                            ievent.update_ha_state()
-                            self.currentevents[guid] = ievent
-                            self.currentevents[guid].keep_alive(starttime,
-                                                                endtime,
-                                                                duration,
-                                                                title,
-                                                                tz,
-                                                                location)
-
-                        starttime = None
-                        endtime = None
-                        duration = None
-                        title = None
-                        tz = pytz.utc
-                        location = None
-                        guid = None
-                    
-                    starttime = None
-                    endtime = None
-                    duration = None
-                    title = None
-                    tz = pytz.utc
-                    location = None
-                    guid = None
-                    for event in new_events:
-                        tz = event['tz']
-                        if tz is None:
-                            tz = pytz.utc
-                        else:
-                            tz = timezone(tz)
-                        tempnow = dt_util.now(tz)
-                        guid = event['guid']
-                        starttime = event['startDate']
-                        startdate = datetime(starttime[1],
-                                             starttime[2],
-                                             starttime[3],
-                                             starttime[4],
-                                             starttime[5], 0, 0, tz)
-                        endtime = event['endDate']
-                        enddate = datetime(endtime[1], endtime[2],
-                                           endtime[3], endtime[4],
-                                           endtime[5], 0, 0, tz)
-                        duration = event['duration']
-                        title = event['title']
-                        location = event['location']
-                        
-                        strnow = tempnow.strftime("%Y%m%d%H%M%S")
-                        strstart = startdate.strftime("%Y%m%d%H%M%S")
-                        strend = enddate.strftime("%Y%m%d%H%M%S")
-                        
-                        if strnow < strstart:
-                            ievent = IEvent(self.hass, self, guid,
-                                            TYPE_NEXT)
-                            ievent.update_ha_state()
-                            self.nextevents[guid] = ievent
-                            self.nextevents[guid].keep_alive(starttime,
-                                                             endtime,
-                                                             duration,
-                                                             title,
-                                                             tz,
-                                                             location)
-                        
+                # Resume the stored session or login to iCloud
+                await LIMITER.acquire(self.accountname)
+                await self.async_login()
             except PyiCloudFailedLoginException as error:
+                self.breaker.failure(trip=True)
                 _LOGGER.error('Error logging into iCloud Service: %s',
                               error)
+                return
+            await self.async_discover()
+            if self.getevents:
+                await self.async_update_events(TickClock())
+        finally:
+            self._startuptime = round(time.time() - initstart, 2)
+            self.ready.set()
+            self.update_ha_state()
+            _LOGGER.info("iCloud account %s started in %s seconds with %s "
+                         "login(s), session resumed: %s", self.accountname,
+                         self._startuptime, self.logins,
+                         self.api is not None and self.api.resumed)
+
+    async def async_discover(self):
+        """ Adds the devices of the account and follows their trackers """
+        await self.async_refresh_fleet(profile=PROFILE_FULL)
+        with STATE_WRITES.cycle():
+            for device in self._devicemanager.values():
+                devicename = devicename_from(device.content['name'])
+                if (devicename not in self.devices and
+                    devicename not in self._ignored_devices):
+                    idevice = IDevice(self.hass, self, devicename, device)
+                    idevice.update_ha_state()
+                    self.devices[devicename] = idevice
+                    track_state_change(self.hass,
+                                       'device_tracker.' + devicename,
+                                       idevice.devicechanged)
+                    SCHEDULER.schedule(idevice)
+                elif devicename in self._ignored_devices:
+                    self._ignored_identifiers[devicename] = device
+        self._discovered = True
+
+    @property
+    def logins(self):
+        """ Returns the number of full logins since the start """
+        return self.api.logins if self.api is not None else 0
 
     @property
     def state(self):
         """ returns the state of the icloud tracker """
+        if not self.ready.is_set():
+            return STATE_LOADING
         return self.api is not None
 
     @property
     def state_attributes(self):
         """ returns the friendlyname of the icloud tracker """
-        return {
-            ATTR_ACCOUNTNAME: self.accountname
+        attributes = {
+            ATTR_ACCOUNTNAME: self.accountname,
+            ATTR_LOGINS: self.logins,
+            ATTR_STARTUPTIME: self._startuptime,
+            ATTR_RESUMED: self.api is not None and self.api.resumed,
+            ATTR_CIRCUIT: self.breaker.state,
+            ATTR_FAILURES: self.breaker.failures,
+            ATTR_RETRYAT: (None if self.breaker.retry_at is None else
+                           dt_util.utc_from_timestamp(
+                               self.breaker.retry_at).isoformat()),
+            ATTR_SNAPSHOTHITS: self.snapshots.hits,
+            ATTR_SNAPSHOTMISSES: self.snapshots.misses,
+            ATTR_SNAPSHOTHITRATE: self.snapshots.hit_rate
         }
+        attributes.update(self.stats.attributes())
+        return attributes
         
     @property
     def icon(self):
@@ -715,193 +2273,333 @@ class Icloud(Entity):  # pylint: disable=too-many-instance-attributes
         
     def keep_alive(self):
         """ Keeps the api alive """
-        if self.api is None:
-            try:
-                # Attempt the login to iCloud
-                self.api = PyiCloudService(self.username,
-                                           self.password,
-                                           verify=True)
-                        
-            except PyiCloudFailedLoginException as error:
-                _LOGGER.error('Error logging into iCloud Service: %s',
-                              error)
-        
-        
+        ENGINE.run(self.async_keep_alive())
+
+    async def async_keep_alive(self, clock=None):
+        """ Logs in if needed and updates the calendar """
+        if not self.ready.is_set():
+            # still starting
+            return
+        try:
+            # a failing login is retried when the circuit allows it
+            if self.api is None and self.breaker.allow():
+                try:
+                    await LIMITER.acquire(self.accountname)
+                except BaseException:
+                    self.breaker.cancel()
+                    raise
+                try:
+                    # Attempt the login to iCloud
+                    await self.async_login()
+
+                except PyiCloudFailedLoginException as error:
+                    self.breaker.failure(trip=True)
+                    _LOGGER.error('Error logging into iCloud Service: %s',
+                                  error)
+                except BaseException:
+                    self.breaker.failure()
+                    raise
+                else:
+                    self.breaker.success()
+
+            if self.api is not None and not self._discovered:
+                # logged in after a failed start
+                await self.async_discover()
+
+            if self.api is not None and self.getevents:
+                await self.async_update_events(clock)
+
+        finally:
+            # the call statistics and the circuit of the account are
+            # written once a minute
+            self.update_ha_state()
+
+    async def async_call(self, operation, func, *args,
+                         priority=PRIORITY_BACKGROUND):
+        """ Calls iCloud through the circuit breaker, the rate limiter and
+        the session """
+        if not self.breaker.allow():
+            raise ICircuitOpenError(self.accountname, self.breaker.retry_at)
+        try:
+            await LIMITER.acquire(self.accountname, priority)
+        except BaseException:
+            # the call wasn't made, a throttled account is no failure
+            self.breaker.cancel()
+            raise
+        try:
+            with self.stats.timed(operation):
+                result = await ENGINE.call(self.session.call, func, *args)
+        except PyiCloudFailedLoginException:
+            # the session logged in again and failed, as a login would
+            self.breaker.failure(trip=True)
+            raise
+        except BaseException as error:
+            if (isinstance(error, PyiCloudAPIResponseError) and
+                    is_throttle_error(error)):
+                LIMITER.throttled(self.accountname)
+            self.breaker.failure()
+            raise
+        LIMITER.recovered(self.accountname)
+        self.breaker.success()
+        return result
+
+    async def async_poll_devices(self, devicenames):
+        """ Updates the devices that are due from one fleet refresh """
         if self.api is not None:
-            self.api.authenticate()
-            for devicename in self.devices:
-                self.devices[devicename].keep_alive()
-            if self.getevents:
-                from_dt = dt_util.now()
-                to_dt = from_dt + timedelta(days=7)
-                events = self.api.calendar.events(from_dt, to_dt)
-                new_events = sorted(events.list_of_dict, key=operator.attrgetter('startDate'))
-                starttime = None
-                endtime = None
-                duration = None
-                title = None
-                tz = pytz.utc
-                location = None
-                guid = None
-                for event in new_events:
-                    tz = event['tz']
-                    if tz is None:
-                        tz = pytz.utc
-                    else:
-                        tz = timezone(tz)
-                    tempnow = dt_util.now(tz)
-                    guid = event['guid']
-                    starttime = event['startDate']
-                    startdate = datetime(starttime[1], starttime[2],
-                                         starttime[3], starttime[4],
-                                         starttime[5], 0, 0, tz)
-                    endtime = event['endDate']
-                    enddate = datetime(endtime[1], endtime[2], endtime[3],
-                                       endtime[4], endtime[5], 0, 0, tz)
-                    duration = event['duration']
-                    title = event['title']
-                    location = event['location']
-                        
-                    strnow = tempnow.strftime("%Y%m%d%H%M%S")
-                    strstart = startdate.strftime("%Y%m%d%H%M%S")
-                    strend = enddate.strftime("%Y%m%d%H%M%S")
-                        
-                    if strnow > strstart and strend > strnow:
-                        if guid not in self.currentevents:
-                            ievent = IEvent(self.hass, self, guid,
-                                            TYPE_CURRENT)
-                            ievent.update_ha_state()
-                            self.currentevents[guid] = ievent
-                        self.currentevents[guid].keep_alive(starttime,
-                                                            endtime,
-                                                            duration,
-                                                            title,
-                                                            tz,
-                                                            location)
-                    starttime = None
-                    endtime = None
-                    duration = None
-                    title = None
-                    tz = pytz.utc
-                    location = None
-                    guid = None
-                    
-                for addedevent in self.currentevents:
-                    found = False
-                    eventguid = self.currentevents[addedevent].eventguid
-                    for event in new_events:
-                        if event['guid'] == eventguid:
-                            found = True
-                    if not found:
-                        ent_id = generate_entity_id(ENTITY_ID_FORMAT_EVENT,
-                                                    eventguid,
-                                                    hass=self.hass)
-                        self.hass.states.remove(ent_id)
-                        del self.currentevents[addedevent]
-                    else:
-                        self.currentevents[addedevent].check_alive()
-                
-                starttime = None
-                endtime = None
-                duration = None
-                title = None
-                tz = pytz.utc
-                location = None
-                guid = None
-                for event in new_events:
-                    tz = event['tz']
-                    if tz is None:
-                        tz = pytz.utc
-                    else:
-                        tz = timezone(tz)
-                    tempnow = dt_util.now(tz)
-                    guid = event['guid']
-                    starttime = event['startDate']
-                    startdate = datetime(starttime[1],
-                                         starttime[2],
-                                         starttime[3],
-                                         starttime[4],
-                                         starttime[5], 0, 0, tz)
-                    endtime = event['endDate']
-                    enddate = datetime(endtime[1], endtime[2],
-                                       endtime[3], endtime[4],
-                                       endtime[5], 0, 0, tz)
-                    duration = event['duration']
-                    title = event['title']
-                    location = event['location']
-                        
-                    strnow = tempnow.strftime("%Y%m%d%H%M%S")
-                    strstart = startdate.strftime("%Y%m%d%H%M%S")
-                    strend = enddate.strftime("%Y%m%d%H%M%S")
-                        
-                    if strnow < strstart:
-                        if guid not in self.nextevents:
-                            ievent = IEvent(self.hass, self, guid,
-                                            TYPE_NEXT)
-                            ievent.update_ha_state()
-                            self.nextevents[guid] = ievent
-                        self.nextevents[guid].keep_alive(starttime,
-                                                         endtime,
-                                                         duration,
-                                                         title,
-                                                         tz,
-                                                         location)
-                for addedevent in self.nextevents:
-                    found = False
-                    eventguid = self.nextevents[addedevent].eventguid
-                    for event in new_events:
-                        if event['guid'] == eventguid:
-                            found = True
-                    if not found:
-                        ent_id = generate_entity_id(ENTITY_ID_FORMAT_EVENT,
-                                                    eventguid,
-                                                    hass=self.hass)
-                        self.hass.states.remove(ent_id)
-                        del self.nextevents[addedevent]
-                    else:
-                        self.nextevents[addedevent].check_alive()
+            near = any(self.devices[devicename].is_near()
+                       for devicename in devicenames)
+            # devices refining their fix need a fresh one
+            refining = any(self.devices[devicename]._refinestart is not None
+                           for devicename in devicenames)
+            fleet = await self.async_refresh_fleet(
+                None if refining else FLEET_MAX_AGE,
+                PRIORITY_NEAR if near else PRIORITY_BACKGROUND,
+                devicenames=devicenames)
+            self.update_devices(see, fleet, devicenames)
+
+    def update_devices(self, see, fleet, devicenames):
+        """ Updates devices from a fleet snapshot in one write cycle """
+        located = [devicename for devicename in devicenames
+                   if fleet.get(devicename) and fleet[devicename]['location']]
+        fixes = [(fleet[devicename]['location']['latitude'],
+                  fleet[devicename]['location']['longitude'])
+                 for devicename in located]
+        # the nearest zones of all devices in one pass
+        for devicename, fix, proximity in zip(located, fixes,
+                                              PROXIMITY.nearest(fixes)):
+            self.devices[devicename].set_proximity(fix, proximity)
+        with STATE_WRITES.cycle():
+            for devicename in devicenames:
+                self.devices[devicename].update_status(
+                    see, fleet.get(devicename))
+
+    async def async_update_events(self, clock=None):
+        """ Updates the events, fetching them when the cache expired """
+        clock = clock or TickClock()
+        if self.calendar.expired():
+            from_dt = clock.now()
+            to_dt = from_dt + timedelta(days=CALENDAR_WINDOW)
+            events = await self.async_call(STATS_CALENDAR,
+                                           self.api.calendar.events,
+                                           from_dt, to_dt)
+            added, changed, removed = self.calendar.update(events)
+            _LOGGER.debug("Calendar of %s: %s added, %s changed, %s removed",
+                          self.accountname, len(added), len(changed),
+                          len(removed))
+        with STATE_WRITES.cycle():
+            self.update_events(clock)
+
+    def update_events(self, clock):
+        """ Reconciles the event entities with the cached events.
+
+        Each event is classified in one pass, after which the added, changed
+        and removed events of both types follow from the guids.
+        """
+        now = clock.epoch
+        current = collections.OrderedDict()
+        upcoming = collections.OrderedDict()
+        for guid, event in self.calendar.events.items():
+            start, end = self.calendar.times[guid]
+            if start < now < end:
+                current[guid] = event
+            elif now < start:
+                upcoming[guid] = event
+
+        self.currentevents = self.reconcile_events(self.currentevents,
+                                                   current, TYPE_CURRENT,
+                                                   clock)
+        self.nextevents = self.reconcile_events(self.nextevents,
+                                                upcoming, TYPE_NEXT, clock)
+
+    def reconcile_events(self, ievents, events, eventtype, clock):
+        """ Returns the event entities for the events of one type """
+        for guid in set(ievents) - set(events):
+            STATE_WRITES.remove(ievents[guid])
+        reconciled = {}
+        for guid in events:
+            event = events[guid]
+            ievent = ievents.get(guid)
+            if ievent is None:
+                ievent = IEvent(self.hass, self, guid, eventtype)
+            if ievent.event is not event:
+                # added, or changed since the last fetch of the calendar
+                ievent.event = event
+                start, end = self.calendar.times[guid]
+                ievent.keep_alive(start, end, event['duration'],
+                                  event['title'], self.calendar.zones[guid],
+                                  event['location'], clock)
+            else:
+                ievent.check_alive(clock)
+            reconciled[guid] = ievent
+        return reconciled
+
+    def select_devices(self, devicename=None):
+        """ Returns the known devices of one, a list or all devicenames and
+        the results of the unknown ones """
+        devicenames = service_targets(devicename)
+        if devicenames is None:
+            return list(self.devices), {}
+        known = []
+        results = {}
+        for name in devicenames:
+            if name in self.devices:
+                known.append(name)
+            else:
+                _LOGGER.error("devicename %s unknown for account %s",
+                              name, self.accountname)
+                results[name] = 'unknown device'
+        return known, results
 
     def lost_iphone(self, devicename):
         """ Calls the lost iphone function if the device is found """
-        if self.api is not None:
-            self.api.authenticate()
-            if devicename is not None:
-                if devicename in self.devices:
-                    self.devices[devicename].play_sound()
-                else:
-                    _LOGGER.error("devicename %s unknown for account %s",
-                                  devicename, self.accountname)
-            else:
-                for device in self.devices:
-                    self.devices[device].play_sound()
+        return ENGINE.run(self.async_lost_iphone(devicename))
+
+    async def async_lost_iphone(self, devicename):
+        """ Plays a sound on one, a list or all devices at the same time.
+
+        Returns the error of every device, None if the sound was played.
+        """
+        devicenames, results = self.select_devices(devicename)
+        if self.api is None:
+            results.update((name, 'not logged in') for name in devicenames)
+            return results
+        sounds = await asyncio.gather(
+            *[self.devices[name].async_lost_iphone() for name in devicenames],
+            return_exceptions=True)
+        for name, sound in zip(devicenames, sounds):
+            results[name] = (str(sound) if isinstance(sound, Exception)
+                             else None)
+        return results
 
-    def update_icloud(self, see, devicename=None):
+    def update_icloud(self, see, devicename=None,
+                      priority=PRIORITY_BACKGROUND, max_age=None):
         """ Authenticate against iCloud and scan for devices. """
-        if self.api is not None:
-            from pyicloud.exceptions import PyiCloudNoDevicesException
+        return ENGINE.run(self.async_update_icloud(see, devicename, priority,
+                                                   max_age))
 
-            try:
-                # The session timeouts if we are not using it so we
-                # have to re-authenticate. This will send an email.
-                self.api.authenticate()
-                if devicename is not None:
-                    if devicename in self.devices:
-                        self.devices[devicename].update_icloud(see)
-                    else:
-                        _LOGGER.error("devicename %s unknown for account %s",
-                                      devicename, self.accountname)
-                else:
-                    for device in self.devices:
-                        self.devices[device].update_icloud(see)
-                
-            except PyiCloudNoDevicesException:
-                _LOGGER.error('No iCloud Devices found!')
+    async def async_update_icloud(self, see, devicename=None,
+                                  priority=PRIORITY_BACKGROUND,
+                                  max_age=None):
+        """ Updates one, a list or all devices from one fleet refresh.
+
+        Without max_age the devices are refreshed, else a snapshot of at
+        most max_age seconds will do. Returns the error of every device,
+        None if it was updated.
+        """
+        devicenames, results = self.select_devices(devicename)
+        if self.api is None:
+            results.update((name, 'not logged in') for name in devicenames)
+            return results
+        if not devicenames:
+            return results
+        from pyicloud.exceptions import PyiCloudNoDevicesException
+
+        try:
+            fleet = await self.async_refresh_fleet(max_age, priority,
+                                                   devicenames=devicenames)
+            self.update_devices(see, fleet, devicenames)
+            results.update((name, None) for name in devicenames)
+        except PyiCloudNoDevicesException:
+            _LOGGER.error('No iCloud Devices found!')
+            results.update((name, 'no devices') for name in devicenames)
+        return results
                 
-    def setinterval(self, interval=None, devicename=None):
-        if devicename is None:
-            for device in self.devices:
-                device.setinterval(interval)
-                device.update_icloud(see)
-        elif devicename in self.devices:
-            self.devices[devicename] = setinterval(interval)
-            self.devices[devicename].update_icloud(see)
+    async def async_login(self):
+        """ Logs in on the engine, keeping the api only if the login
+        finished in time """
+        api = await ENGINE.call(self.login)
+        self.api = api
+        self.session = ISession(self.api, stats=self.stats)
+
+    def login(self):
+        """ Resumes the stored session of the account or logs in, returns
+        the api """
+        start = time.time()
+        try:
+            api = StoredPyiCloudService(self.username, self.password,
+                                        self._store, verify=True)
+        except Exception:
+            self.stats.record(STATS_LOGIN, time.time() - start, True)
+            raise
+        if not api.resumed:
+            self.stats.record(STATS_LOGIN, time.time() - start)
+        return api
+
+    def refresh_fleet(self, max_age=None, profile=PROFILE_LOCATION,
+                      devicenames=None):
+        """ Fetches the status of all devices of the account in one call.
+
+        If the snapshots of the devices, or of the given devicenames, are
+        younger than max_age seconds they are returned as is. The profile
+        names the fields kept of every device.
+        """
+        return ENGINE.run(self.async_refresh_fleet(
+            max_age, profile=profile, devicenames=devicenames))
+
+    async def async_refresh_fleet(self, max_age=None,
+                                  priority=PRIORITY_BACKGROUND,
+                                  profile=PROFILE_LOCATION,
+                                  devicenames=None):
+        """ Refreshes the fleet, sharing a refresh that is running with at
+        least the priority of the caller """
+        if max_age is not None:
+            fleet = self.snapshots.fleet(max_age, profile, devicenames)
+            if fleet is not None:
+                self.snapshots.hits += 1
+                return fleet
+        # a full snapshot holds the fields of every profile
+        covers = (profile, PROFILE_FULL)
+        running = self._fleet_refresh
+        if (running is None or running[0] not in covers or
+                running[1] > priority):
+            self.snapshots.misses += 1
+            self._fleet_refresh = (profile, priority, asyncio.ensure_future(
+                self._async_fetch_fleet(priority, profile)))
+        else:
+            # the refresh that is running is shared
+            self.snapshots.hits += 1
+        refresh = self._fleet_refresh
+        try:
+            return await asyncio.shield(refresh[2])
+        finally:
+            if self._fleet_refresh is refresh and refresh[2].done():
+                self._fleet_refresh = None
+
+    async def _async_fetch_fleet(self, priority=PRIORITY_BACKGROUND,
+                                 profile=PROFILE_LOCATION):
+        """ Fetches the status of all devices of the account """
+        if self._devicemanager is None:
+            self._devicemanager = await self.async_call(
+                STATS_FLEET, lambda: self.api.devices, priority=priority)
+        else:
+            await self.async_call(STATS_FLEET,
+                                  self._devicemanager.refresh_client,
+                                  priority=priority)
+        fleet = {}
+        for device in self._devicemanager.values():
+            status = device_status(device.content, profile)
+            fleet[devicename_from(status['name'])] = status
+        self.snapshots.update(fleet, profile)
+        return fleet
+
+    def history_path(self, devicename):
+        """ Returns the file of the fix history of a device, None if the
+        history is kept in memory only """
+        if not self.historystore:
+            return None
+        accountname = re.sub(r"\W", '', self.accountname)
+        return self.hass.config.path(SESSION_STORE, HISTORY_STORE,
+                                     '%s_%s.fixes' % (accountname, devicename))
+
+    def setinterval(self, interval=None, devicename=None, update=True):
+        """ Sets the interval of one, a list or all devices and updates
+        them """
+        devicenames, _ = self.select_devices(devicename)
+        if not devicenames:
+            return
+        with STATE_WRITES.cycle():
+            for name in devicenames:
+                self.devices[name].setinterval(interval)
+        if update:
+            # the devices are updated in a cycle of their own on the engine
+            self.update_icloud(see, devicenames, PRIORITY_USER)
@@ -0,0 +1,731 @@
+"""
+icloud_benchmark
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+Offline benchmark of the iCloud platform.
+
+Runs setup(), the minute keep_alive, update_icloud and the polls of the
+scheduler against a simulated fleet of iCloud accounts, devices and
+calendar events, without Apple accounts or a running Home Assistant. A
+fake PyiCloudService with injected latency and errors and a minimal hass
+stand-in replace the real ones. The scheduler tick moves a fake clock on by
+a minute and fires the timers that are due.
+
+Reported per scenario: setup time, tick latency percentiles, API calls per
+tick, state writes per tick and memory. The fleet, the movements of the
+devices and the injected errors come from seeded random generators, one
+per account, so runs with the same arguments are comparable.
+
+Usage:
+    python icloud_benchmark.py
+    python icloud_benchmark.py --accounts 1,10 --devices 1,10 --events 0,50
+"""
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+import pytz
+
+OPERATIONS = ['login', 'refresh', 'calendar', 'sound']
+
+DEFAULT_ACCOUNTS = '1,10,100'
+DEFAULT_DEVICES = '1,10,50'
+DEFAULT_EVENTS = '0,50,500'
+
+
+class FakeClock(object):
+    """ Clock of the platform that the scheduler tick moves on """
+    def __init__(self):
+        self.offset = 0
+
+    def time(self):
+        """ Returns the epoch seconds of the fake clock """
+        return time.time() + self.offset
+
+    def advance(self, seconds):
+        """ Moves the clock on """
+        self.offset += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+CLOCK = FakeClock()
+
+
+class FakeApi(object):
+    """ Counts the calls of the simulated iCloud and injects latency and
+    errors. Every account draws from a random generator of its own, so
+    accounts running side by side don't change each other's draws. """
+    def __init__(self, latency=0.0, jitter=0.0, errors=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.seed = seed
+        self.calls = collections.Counter()
+        self.fleets = {}
+        self.calendars = {}
+        self._randoms = {}
+        self._lock = threading.Lock()
+
+    def reset(self, seed):
+        """ Starts the random generators of the accounts again """
+        with self._lock:
+            self.seed = seed
+            self._randoms.clear()
+
+    def _random(self, account):
+        """ Returns the random generator of an account """
+        rand = self._randoms.get(account)
+        if rand is None:
+            rand = self._randoms[account] = random.Random(
+                '%s-%s' % (self.seed, account))
+        return rand
+
+    def call(self, operation, account):
+        """ Counts a call, sleeps its latency and maybe fails it """
+        with self._lock:
+            rand = self._random(account)
+            self.calls[operation] += 1
+            delay = self.latency + rand.uniform(0, self.jitter)
+            failed = rand.random() < self.errors
+        if delay:
+            time.sleep(delay)
+        if failed:
+            from pyicloud.exceptions import PyiCloudAPIResponseError
+            raise PyiCloudAPIResponseError('Internal Server Error', 500)
+
+    def move(self, content, account):
+        """ Moves about half of the devices a bit """
+        with self._lock:
+            rand = self._random(account)
+            moves = rand.random() < 0.5
+            step = rand.uniform(-0.001, 0.001)
+        if moves:
+            location = dict(content['location'])
+            location['latitude'] += step
+            location['longitude'] += step
+            location['timeStamp'] = int(CLOCK.time() * 1000)
+            content['location'] = location
+
+
+API = FakeApi()
+
+
+class FakeCookieJar(object):
+    """ Cookie jar of the simulated session """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def save(self):
+        """ Writes the cookies """
+        with open(self.filename, 'w') as cookiefile:
+            cookiefile.write('#LWP-Cookies-2.0\n')
+
+    def load(self):
+        """ Reads the cookies """
+        pass
+
+
+class FakeSession(object):
+    """ Session of the simulated iCloud """
+    def __init__(self, filename):
+        self.cookies = FakeCookieJar(filename)
+        self.verify = True
+
+
+class FakeAppleDevice(object):
+    """ Device of the simulated Find My iPhone service """
+    def __init__(self, manager, content):
+        self.manager = manager
+        self.content = content
+
+    def update(self, content):
+        """ Replaces the content of the device """
+        self.content = content
+
+    def status(self, additional=None):
+        """ Refreshes all devices and returns some fields """
+        self.manager.refresh_client()
+        fields = ['batteryLevel', 'deviceDisplayName', 'deviceStatus', 'name']
+        fields += additional or []
+        return {field: self.content.get(field) for field in fields}
+
+    def play_sound(self, subject='Find My iPhone Alert'):
+        """ Plays a sound on the device """
+        API.call('sound', self.manager.service.user['apple_id'])
+
+    def __getitem__(self, key):
+        return self.content[key]
+
+
+class FakeFindMyiPhoneServiceManager(object):
+    """ Simulated Find My iPhone service, refreshes all devices at once """
+    def __init__(self, service):
+        self.service = service
+        self._devices = collections.OrderedDict()
+        self.refresh_client()
+
+    def refresh_client(self):
+        """ Refreshes the content of all devices """
+        account = self.service.user['apple_id']
+        API.call('refresh', account)
+        for content in API.fleets[account]:
+            API.move(content, account)
+            if content['id'] in self._devices:
+                self._devices[content['id']].update(dict(content))
+            else:
+                self._devices[content['id']] = FakeAppleDevice(
+                    self, dict(content))
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = list(self._devices)[key]
+        return self._devices[key]
+
+    def keys(self):
+        """ Returns the device ids """
+        return self._devices.keys()
+
+    def values(self):
+        """ Returns the devices """
+        return self._devices.values()
+
+    def __len__(self):
+        return len(self._devices)
+
+
+class FakeCalendarService(object):
+    """ Simulated calendar service """
+    def __init__(self, service):
+        self.service = service
+
+    def events(self, from_dt=None, to_dt=None):
+        """ Returns copies of the events of the account """
+        API.call('calendar', self.service.user['apple_id'])
+        return [dict(event)
+                for event in API.calendars[self.service.user['apple_id']]]
+
+
+class FakePyiCloudService(object):
+    """ Simulated PyiCloudService, logs in on creation like the real one """
+    def __init__(self, apple_id, password=None, cookie_directory=None,
+                 verify=True):
+        self.user = {'apple_id': apple_id, 'password': password}
+        self.data = {}
+        self.params = {}
+        self._cookie_directory = cookie_directory or tempfile.gettempdir()
+        self.session = FakeSession(os.path.join(
+            self._cookie_directory, re.sub(r'\W', '', apple_id)))
+        self.authenticate()
+
+    def authenticate(self):
+        """ Logs in """
+        API.call('login', self.user['apple_id'])
+        if not os.path.exists(self._cookie_directory):
+            os.mkdir(self._cookie_directory)
+        self.session.cookies.save()
+        self.data = {'dsInfo': {'dsid': self.user['apple_id']},
+                     'webservices': {'findme': {'url': 'fake'},
+                                     'calendar': {'url': 'fake'}}}
+        self.params['dsid'] = self.user['apple_id']
+        self.webservices = self.data['webservices']
+
+    @property
+    def devices(self):
+        """ Returns the Find My iPhone service """
+        return FakeFindMyiPhoneServiceManager(self)
+
+    @property
+    def calendar(self):
+        """ Returns the calendar service """
+        return FakeCalendarService(self)
+
+
+class FakeState(object):
+    """ State of an entity """
+    def __init__(self, entity_id, state, attributes):
+        self.entity_id = entity_id
+        self.state = state
+        self.attributes = attributes
+
+
+class FakeStates(object):
+    """ State machine that counts its writes """
+    def __init__(self, hass):
+        self.hass = hass
+        self.writes = 0
+        self.listeners = collections.defaultdict(list)
+        self._states = {}
+        self._lock = threading.RLock()
+
+    def get(self, entity_id):
+        """ Returns the state of an entity """
+        return self._states.get(entity_id)
+
+    def set(self, entity_id, new_state, attributes=None, force_update=False):
+        """ Writes a state and calls the listeners of the entity """
+        with self._lock:
+            self.writes += 1
+            old = self._states.get(entity_id)
+            new = FakeState(entity_id, str(new_state), dict(attributes or {}))
+            self._states[entity_id] = new
+            listeners = list(self.listeners.get(entity_id, ()))
+        self.hass.bus.fire('state_changed', {'entity_id': entity_id,
+                                             'old_state': old,
+                                             'new_state': new})
+        for listener in listeners:
+            listener(entity_id, old, new)
+
+    def remove(self, entity_id):
+        """ Removes the state of an entity """
+        with self._lock:
+            return self._states.pop(entity_id, None) is not None
+
+    def entity_ids(self, domain_filter=None):
+        """ Returns the entity ids, optionally of one domain """
+        with self._lock:
+            return [entity_id for entity_id in self._states
+                    if domain_filter is None or
+                    entity_id.startswith(domain_filter + '.')]
+
+
+class FakeEvent(object):
+    """ Event on the bus """
+    def __init__(self, event_type, data):
+        self.event_type = event_type
+        self.data = data or {}
+
+
+class FakeBus(object):
+    """ Event bus that calls its listeners right away """
+    def __init__(self):
+        self.listeners = collections.defaultdict(list)
+
+    def listen(self, event_type, listener):
+        """ Adds a listener """
+        self.listeners[event_type].append(listener)
+
+    def listen_once(self, event_type, listener):
+        """ Adds a listener """
+        self.listeners[event_type].append(listener)
+
+    def fire(self, event_type, event_data=None):
+        """ Calls the listeners of an event """
+        event = FakeEvent(event_type, event_data)
+        for listener in list(self.listeners.get(event_type, ())):
+            listener(event)
+
+
+class FakeServiceCall(object):
+    """ Call of a service """
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeServices(object):
+    """ Service registry """
+    def __init__(self):
+        self.services = {}
+
+    def register(self, domain, service, service_func, schema=None):
+        """ Registers a service """
+        self.services[(domain, service)] = service_func
+
+    def call(self, domain, service, service_data=None, blocking=False):
+        """ Calls a service right away """
+        self.services[(domain, service)](FakeServiceCall(service_data or {}))
+
+
+class FakeConfig(object):
+    """ Configuration of hass """
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+
+    def path(self, *path):
+        """ Returns a path in the config dir """
+        return os.path.join(self.config_dir, *path)
+
+
+class FakeHass(object):
+    """ Minimal stand-in for Home Assistant """
+    def __init__(self, config_dir):
+        self.states = FakeStates(self)
+        self.bus = FakeBus()
+        self.services = FakeServices()
+        self.config = FakeConfig(config_dir)
+        self.timers = []
+        self.points = []
+        self.points_lock = threading.Lock()
+
+    def fire_points(self):
+        """ Fires the points in time the fake clock has passed """
+        for _ in range(100):
+            with self.points_lock:
+                now = CLOCK.time()
+                due = [point for point in self.points
+                       if point[0].timestamp() <= now]
+                self.points = [point for point in self.points
+                               if point[0].timestamp() > now]
+            if not due:
+                return
+            for point_in_time, action in due:
+                action(point_in_time)
+
+
+class FakeEntity(object):
+    """ Entity base class """
+    hass = None
+    entity_id = None
+
+    @property
+    def state(self):
+        """ Returns the state """
+        return 'unknown'
+
+    @property
+    def state_attributes(self):
+        """ Returns the attributes """
+        return None
+
+    def update_ha_state(self, force_refresh=False):
+        """ Writes the state """
+        self.hass.states.set(self.entity_id, self.state,
+                             self.state_attributes)
+
+
+def generate_entity_id(entity_id_format, name, current_ids=None, hass=None):
+    """ Returns an entity id for a name """
+    return entity_id_format.format(
+        re.sub(r'\W+', '_', str(name).lower()).strip('_'))
+
+
+def see(hass, mac=None, dev_id=None, host_name=None, location_name=None,
+        gps=None, gps_accuracy=None, battery=None):
+    """ Device tracker see service, every fix is away from home """
+    hass.states.set('device_tracker.' + dev_id, 'not_home',
+                    {'latitude': gps[0], 'longitude': gps[1],
+                     'gps_accuracy': gps_accuracy, 'battery': battery})
+
+
+def track_state_change(hass, entity_ids, action, from_state=None,
+                       to_state=None):
+    """ Calls the action when an entity changes """
+    if isinstance(entity_ids, str):
+        entity_ids = [entity_ids]
+    for entity_id in entity_ids:
+        hass.states.listeners[entity_id].append(action)
+    return action
+
+
+def track_time(kind):
+    """ Returns a tracker that records its timers """
+    def track(hass, action, *args, **kwargs):
+        """ Records a timer """
+        hass.timers.append((kind, action, args, kwargs))
+        return action
+    return track
+
+
+def track_point_in_time(hass, action, point_in_time):
+    """ Records a point in time """
+    with hass.points_lock:
+        hass.points.append((point_in_time, action))
+    return action
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Returns the distance between two points in meters """
+    import icloud
+    return icloud.haversine(lat1, lon1, lat2, lon2)
+
+
+def install_fakes():
+    """ Puts the fake pyicloud and homeassistant modules in place """
+    class PyiCloudException(Exception):
+        """ Base exception """
+
+    class PyiCloudAPIResponseError(PyiCloudException):
+        """ Error answered by the simulated iCloud """
+        def __init__(self, reason, code):
+            self.reason = reason
+            self.code = code
+            super(PyiCloudAPIResponseError, self).__init__(
+                '%s (%s)' % (reason, code))
+
+    class PyiCloudFailedLoginException(PyiCloudException):
+        """ Failed login """
+
+    class PyiCloudNoDevicesException(PyiCloudException):
+        """ Account without devices """
+
+    def module(name, **attributes):
+        """ Registers a fake module """
+        fake = types.ModuleType(name)
+        fake.__dict__.update(attributes)
+        sys.modules[name] = fake
+        return fake
+
+    module('pyicloud', PyiCloudService=FakePyiCloudService)
+    module('pyicloud.exceptions',
+           PyiCloudException=PyiCloudException,
+           PyiCloudAPIResponseError=PyiCloudAPIResponseError,
+           PyiCloudFailedLoginException=PyiCloudFailedLoginException,
+           PyiCloudNoDevicesException=PyiCloudNoDevicesException)
+    module('homeassistant')
+    module('homeassistant.const',
+           CONF_USERNAME='username', CONF_PASSWORD='password',
+           CONF_NAME='name', EVENT_HOMEASSISTANT_STOP='homeassistant_stop',
+           EVENT_STATE_CHANGED='state_changed')
+    module('homeassistant.helpers')
+    module('homeassistant.helpers.entity', Entity=FakeEntity,
+           generate_entity_id=generate_entity_id)
+    module('homeassistant.helpers.event',
+           track_state_change=track_state_change,
+           track_time_change=track_time('local'),
+           track_utc_time_change=track_time('utc'),
+           track_point_in_time=track_point_in_time,
+           track_point_in_utc_time=track_point_in_time)
+    module('homeassistant.components')
+    module('homeassistant.components.device_tracker', see=see)
+    module('homeassistant.util')
+    module('homeassistant.util.dt',
+           DEFAULT_TIME_ZONE=pytz.utc,
+           now=lambda time_zone=None: datetime.datetime.now(
+               time_zone or pytz.utc),
+           utcnow=lambda: datetime.datetime.now(pytz.utc),
+           utc_from_timestamp=lambda timestamp:
+           datetime.datetime.fromtimestamp(timestamp, pytz.utc),
+           parse_time=lambda text: datetime.time(
+               *[int(part) for part in text.split(':')]))
+    module('homeassistant.util.location', distance=distance)
+
+
+def calendar_date(moment):
+    """ Returns a date in the format of the iCloud calendar """
+    return [int(moment.strftime('%Y%m%d')), moment.year, moment.month,
+            moment.day, moment.hour, moment.minute,
+            moment.hour * 60 + moment.minute]
+
+
+def build_fleet(accounts, devices, events, seed):
+    """ Fills the simulated iCloud and returns the platform config """
+    rand = random.Random(seed)
+    API.fleets.clear()
+    API.calendars.clear()
+    config = {}
+    now = datetime.datetime.now(pytz.utc).replace(second=0, microsecond=0)
+    for account in range(accounts):
+        apple_id = 'account%d@example.com' % account
+        fleet = []
+        for device in range(devices):
+            fleet.append({
+                'id': 'device-%d-%d' % (account, device),
+                'name': 'Device %d %d' % (account, device),
+                'deviceStatus': rand.choice(['200', '200', '200', '201']),
+                'deviceDisplayName': 'iPhone',
+                'batteryLevel': round(rand.uniform(0.1, 1), 2),
+                'batteryStatus': 'NotCharging',
+                'lowPowerMode': False,
+                'location': {
+                    'latitude': 50.85 + rand.uniform(-0.5, 0.5),
+                    'longitude': 4.35 + rand.uniform(-0.5, 0.5),
+                    'horizontalAccuracy': rand.choice([5, 10, 65]),
+                    'locationFinished': True,
+                    'isInaccurate': False,
+                    'isOld': False,
+                    'timeStamp': int(CLOCK.time() * 1000)}})
+        API.fleets[apple_id] = fleet
+        calendar = []
+        for event in range(events):
+            start = now + datetime.timedelta(
+                minutes=rand.randint(-120, 7 * 1440))
+            duration = rand.choice([15, 30, 60, 120])
+            end = start + datetime.timedelta(minutes=duration)
+            calendar.append({
+                'guid': 'event-%d-%d' % (account, event),
+                'etag': 'C=1@U=1',
+                'startDate': calendar_date(start),
+                'endDate': calendar_date(end),
+                'duration': duration,
+                'title': 'Event %d' % event,
+                'location': None,
+                'tz': rand.choice([None, 'Europe/Brussels', 'US/Pacific'])})
+        API.calendars[apple_id] = calendar
+        config['account%d' % account] = {
+            'username': apple_id,
+            'password': 'secret',
+            'events': events > 0}
+    return {'icloud': config}
+
+
+def percentile(values, percent):
+    """ Returns a percentile of the values """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def measure(hass, func):
+    """ Runs a tick, returns its latency in ms, calls and writes """
+    calls = sum(API.calls.values())
+    writes = hass.states.writes
+    start = time.perf_counter()
+    func()
+    latency = (time.perf_counter() - start) * 1000
+    return (latency, sum(API.calls.values()) - calls,
+            hass.states.writes - writes)
+
+
+def run_scenario(accounts, devices, events, ticks, seed, paced=False):
+    """ Runs setup and the ticks of one scenario, returns its results """
+    config = build_fleet(accounts, devices, events, seed)
+    config_dir = tempfile.mkdtemp(prefix='icloud_benchmark')
+    icloud = sys.modules.get('icloud')
+    if icloud is not None:
+        icloud.ENGINE.stop()
+        icloud = importlib.reload(icloud)
+    else:
+        icloud = importlib.import_module('icloud')
+    if not paced:
+        # measure the platform itself, not the pacing of the calls
+        icloud.LIMITER = icloud.IcloudRateLimiter(1e9, 1e9, 1e9, 1e9)
+    # the platform runs on the fake clock of the scheduler tick
+    CLOCK.offset = 0
+    icloud.time = CLOCK
+    API.reset(seed)
+    try:
+        hass = FakeHass(config_dir)
+        hass.states.set('zone.home', 'zoning', {
+            'latitude': 50.85, 'longitude': 4.35, 'radius': 100})
+        API.calls.clear()
+        tracemalloc.start()
+
+        def start():
+            """ Sets up the platform and waits until the accounts started """
+            icloud.setup(hass, config)
+            for account in icloud.ICLOUDTRACKERS.values():
+                account.ready.wait()
+
+        setup = measure(hass, start)
+        setupcalls = dict(API.calls)
+        keep_alive = [action for kind, action, args, kwargs in hass.timers
+                      if kind == 'utc'][0]
+
+        def poll():
+            """ Refreshes all devices of all accounts """
+            icloud.ENGINE.run_all(
+                [account.async_update_icloud(icloud.see)
+                 for account in icloud.ICLOUDTRACKERS.values()])
+
+        def scheduler():
+            """ Moves the clock on a minute and polls the due devices """
+            CLOCK.advance(60)
+            hass.fire_points()
+
+        results = {'keep_alive': [], 'update_icloud': [], 'scheduler': []}
+        for _ in range(ticks):
+            results['keep_alive'].append(
+                measure(hass, lambda: keep_alive(None)))
+            results['update_icloud'].append(measure(hass, poll))
+            results['scheduler'].append(measure(hass, scheduler))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            'accounts': accounts, 'devices': devices, 'events': events,
+            'setup_ms': round(setup[0], 1), 'setup_calls': setupcalls,
+            'setup_writes': setup[2],
+            'ticks': {
+                tick: {
+                    'p50_ms': round(percentile(
+                        [result[0] for result in values], 50), 2),
+                    'p90_ms': round(percentile(
+                        [result[0] for result in values], 90), 2),
+                    'p99_ms': round(percentile(
+                        [result[0] for result in values], 99), 2),
+                    'calls': round(sum(result[1] for result in values) /
+                                   float(len(values)), 2),
+                    'writes': round(sum(result[2] for result in values) /
+                                    float(len(values)), 2)}
+                for tick, values in results.items()},
+            'memory_mb': round(current / 1048576.0, 2),
+            'peak_mb': round(peak / 1048576.0, 2)}
+    finally:
+        icloud.ENGINE.stop()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def report(result):
+    """ Prints the results of a scenario as one line per tick type """
+    for tick in sorted(result['ticks']):
+        values = result['ticks'][tick]
+        print('%8d %7d %6d  %-13s %9.2f %9.2f %9.2f %8.2f %8.2f %9.1f '
+              '%8.2f %8.2f' % (
+                  result['accounts'], result['devices'], result['events'],
+                  tick, values['p50_ms'], values['p90_ms'],
+                  values['p99_ms'], values['calls'], values['writes'],
+                  result['setup_ms'], result['memory_mb'],
+                  result['peak_mb']))
+    sys.stdout.flush()
+
+
+def main():
+    """ Runs the benchmark matrix """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--accounts', default=DEFAULT_ACCOUNTS,
+                        help='comma separated numbers of accounts')
+    parser.add_argument('--devices', default=DEFAULT_DEVICES,
+                        help='comma separated numbers of devices per account')
+    parser.add_argument('--events', default=DEFAULT_EVENTS,
+                        help='comma separated numbers of events per account')
+    parser.add_argument('--ticks', type=int, default=20,
+                        help='ticks measured per scenario')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every iCloud call takes')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random extra seconds per iCloud call')
+    parser.add_argument('--errors', type=float, default=0.0,
+                        help='fraction of iCloud calls that fail')
+    parser.add_argument('--paced', action='store_true',
+                        help='pace the calls with the rate limits of the '
+                        'platform')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed of the simulated fleet')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json lines')
+    args = parser.parse_args()
+
+    install_fakes()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    API.latency = args.latency
+    API.jitter = args.jitter
+    API.errors = args.errors
+
+    if not args.json:
+        print('accounts devices events  tick           p50 (ms)  p90 (ms) '
+              ' p99 (ms)    calls   writes  setup ms  mem (MB) peak (MB)')
+    for accounts in [int(value) for value in args.accounts.split(',')]:
+        for devices in [int(value) for value in args.devices.split(',')]:
+            for events in [int(value) for value in args.events.split(',')]:
+                result = run_scenario(accounts, devices, events, args.ticks,
+                                      args.seed, args.paced)
+                if args.json:
+                    print(json.dumps(result, sort_keys=True))
+                else:
+                    report(result)
+
+
+if __name__ == '__main__':
+    main()